@@ -0,0 +1,63 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# assets.py                                         #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import sys
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    # Game related
+    from settings import *
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+def read_text(filename):
+    # A dialog file as one line
+    with open(filename, 'r') as f:
+        return "".join(line.strip() for line in f.readlines())
+
+class AssetPipeline:
+    # Loads assets on a thread pool. Workers only decode and parse,
+    # each result goes through its finish callback on the main thread
+    # so converting surfaces for the display happens there.
+    def __init__(self, workers=ASSET_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self.total = 0
+        self.done = 0
+        self.current = ""
+
+    def add(self, label, work, finish, *args):
+        future = self.pool.submit(work, *args)
+        self.jobs[future] = (label, finish)
+        self.total += 1
+
+    def progress(self):
+        return self.done / self.total if self.total else 1
+
+    def step(self, timeout=None):
+        # Finish whatever is ready, waiting up to timeout for something,
+        # returns False once every job is finished
+        ready, pending = wait(self.jobs, timeout, FIRST_COMPLETED)
+        for future in ready:
+            label, finish = self.jobs.pop(future)
+            finish(future.result())
+            self.done += 1
+            self.current = label
+        return bool(self.jobs)
+
+    def run(self, draw=None):
+        while self.step(1 / FPS):
+            if draw:
+                draw(self)
+        if draw:
+            draw(self)
+        self.pool.shutdown()
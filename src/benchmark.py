@@ -0,0 +1,195 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# benchmark.py                                      #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# Times the main game phases on synthetic maps, writes the results
+# as JSON and fails when one of them regressed against the baseline.
+# Usage: python benchmark.py [--size 256] [--update-baseline] ...
+#
+# Timings only compare on the same machine, so the baseline is local
+# and not versioned. Write it with --update-baseline, on a new machine,
+# after a change meant to change the timings or to benchmark with other
+# arguments: it keeps the arguments it was run with and runs with other
+# ones fail, as do runs without a baseline.
+
+try:
+    # System
+    import os
+    import sys
+    import json
+    import time
+    import random
+    import shutil
+    import argparse
+    import tempfile
+    from os import path
+    # Game related
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    from settings import *
+    from tilemap import TiledMap, MapRegistry
+    from entities import Spritesheet, sprites_in_use
+    from game import Game
+    from headless import run_headless
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+GAME_FOLDER = path.dirname(path.abspath(__file__))
+BASELINE = path.join(GAME_FOLDER, 'benchmark_baseline.json')
+
+FLOOR_GIDS = [1, 4, 5, 555, 587]
+
+# Arguments a baseline only compares under
+PARAMS = ('size', 'bake_size', 'walls', 'entities', 'items', 'mobs', 'triggers', 'frames')
+
+def make_synthetic_map(filename, size, walls, entities, items, mobs, triggers, seed=0):
+    # An orthogonal tmx of size x size tiles using the game's charset
+    rnd = random.Random(seed)
+    tile = 16
+    tileset = path.join(GAME_FOLDER, 'maps', 'charset.tsx')
+
+    rows = []
+    for y in range(size):
+        rows.append(','.join(str(rnd.choice(FLOOR_GIDS)) for x in range(size)))
+
+    objects = []
+    def add(name, x, y, w=tile, h=tile):
+        objects.append('  <object id="{}" name="{}" x="{}" y="{}" width="{}" height="{}"/>'.format(
+            len(objects) + 1, name, x, y, w, h))
+
+    def cell():
+        return rnd.randrange(size) * tile, rnd.randrange(size) * tile
+
+    add('player_start', size // 2 * tile, size // 2 * tile, 0, 0)
+    for i in range(walls):
+        x, y = cell()
+        add('wall', x, y, tile * rnd.randint(1, 4), tile)
+    for i in range(entities):
+        add(rnd.choice(list(ENTITIES)), *cell())
+    for i in range(items):
+        add('pickaxe', *cell(), 0, 0)
+    for i in range(mobs):
+        add('jail_guardian', *cell(), 0, 0)
+    for i in range(triggers):
+        add('jail_event_0', *cell())
+
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<map version="1.2" orientation="orthogonal" renderorder="right-down" '
+                'width="{0}" height="{0}" tilewidth="{1}" tileheight="{1}" infinite="0" '
+                'nextlayerid="3" nextobjectid="{2}">\n'.format(size, tile, len(objects) + 1))
+        f.write(' <tileset firstgid="1" source="{}"/>\n'.format(tileset))
+        f.write(' <layer id="1" name="ground" width="{0}" height="{0}">\n'.format(size))
+        f.write('  <data encoding="csv">\n' + ',\n'.join(rows) + '\n</data>\n </layer>\n')
+        f.write(' <objectgroup id="2" name="objects">\n' + '\n'.join(objects) + '\n </objectgroup>\n')
+        f.write('</map>\n')
+
+def timed(function, repeat=1):
+    # Best of repeat runs, in seconds
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(args):
+    results = {}
+    folder = tempfile.mkdtemp(prefix='sorceler-bench-')
+    big = path.join(folder, 'synthetic.tmx')
+    small = path.join(folder, 'synthetic_small.tmx')
+    make_synthetic_map(big, args.size, args.walls, args.entities, args.items, args.mobs, args.triggers)
+    # A full make_map of the big map would be gigabytes, bake a small one
+    make_synthetic_map(small, args.bake_size, 0, 0, 0, 0, 0)
+
+    game = Game()
+    game.maps = MapRegistry(folder)
+    game.maps_folder = folder
+
+    sheet = path.join(game.assets_folder, SPRITESHEET)
+    results['spritesheet'] = timed(lambda: Spritesheet(sheet).preload(sprites_in_use()), 5)
+
+    results['tiledmap_parse'] = timed(lambda: TiledMap(big), 3)
+    small_map = TiledMap(small)
+    results['make_map'] = timed(small_map.make_map, 3)
+
+    game.new(path.basename(big))
+    results['load_map'] = timed(lambda: game.make_view(path.basename(big)), 3)
+
+    frames = args.frames
+    results['update_frame'] = run_headless(frames, game=game)['seconds'] / frames
+    start = time.perf_counter()
+    for frame in range(frames):
+        game.draw()
+    results['draw_frame'] = (time.perf_counter() - start) / frames
+
+    shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        if name in baseline and seconds > baseline[name] * (1 + tolerance):
+            regressions.append("{}: {:.6f}s against {:.6f}s in the baseline".format(name, seconds, baseline[name]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Rise of the Sorceler benchmarks")
+    parser.add_argument('--size', type=int, default=256, help="synthetic map size in tiles")
+    parser.add_argument('--bake-size', type=int, default=32, help="map size in tiles for make_map")
+    parser.add_argument('--walls', type=int, default=4000)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--mobs', type=int, default=1000)
+    parser.add_argument('--triggers', type=int, default=200)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed slowdown, 0.5 is 50%%")
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in PARAMS}
+    if not args.update_baseline:
+        # Check the baseline first, no use timing anything without one
+        if not path.isfile(args.baseline):
+            print("No baseline at {}, run with --update-baseline".format(args.baseline))
+            sys.exit(1)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print("The baseline was run with {}, not {}, run with --update-baseline".format(
+                baseline.get('params'), params))
+            sys.exit(1)
+
+    results = run(args)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for name, seconds in sorted(results.items()):
+        print("{:<16}{:>12.3f} ms".format(name, seconds * 1000))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+        print("Baseline written to {}".format(args.baseline))
+        return
+
+    regressions = compare(results, baseline['results'], args.tolerance)
+    if regressions:
+        print("REGRESSIONS:")
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+    print("No regression against {}".format(args.baseline))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# checks.py                                         #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# Gameplay checks on the real maps, without a window.
+# Usage: python checks.py
+
+try:
+    # System
+    import os
+    import sys
+    # Game related
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    from settings import *
+    from game import Game
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+def check_jail_door(game):
+    # The jail door of level1 can be used from either side of it
+    game.new('level1.tmx')
+    door = [entity for entity in game.entities if entity.name == 'jail_door_0'][0]
+    failed = []
+    for pos in ((550, 340), (650, 340), (550, 490), (650, 490)):
+        game.player.pos.update(pos)
+        if not game.player.can_use(door):
+            failed.append("jail_door_0 can't be used from {}".format(pos))
+    return failed
+
+CHECKS = (
+    check_jail_door,
+)
+
+if __name__ == '__main__':
+    game = Game()
+    game.autosaving = False
+    failed = []
+    for check in CHECKS:
+        failed += check(game)
+    for failure in failed:
+        print("FAILED: " + failure)
+    print("{} checks, {} failures".format(len(CHECKS), len(failed)))
+    sys.exit(1 if failed else 0)
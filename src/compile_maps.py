@@ -0,0 +1,50 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# compile_maps.py                                   #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# Precompiles every map of the maps folder into its .tmc
+# Usage: python compile_maps.py [map.tmx ...]
+
+try:
+    # System
+    import os
+    import sys
+    from os import path
+    from os import listdir
+    from concurrent.futures import ProcessPoolExecutor
+    # Game related
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame as pg
+    from tilemap import compile_map
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+def init_worker():
+    # Tiles are converted to the display format, so each worker needs one
+    pg.display.init()
+    pg.display.set_mode((1, 1))
+
+def compile_one(filename):
+    return compile_map(filename)
+
+def main(args):
+    maps_folder = path.join(path.dirname(path.abspath(__file__)), 'maps')
+    if args:
+        maps = [path.abspath(f) for f in args]
+    else:
+        maps = [path.join(maps_folder, f) for f in sorted(listdir(maps_folder)) if f.endswith('.tmx')]
+
+    with ProcessPoolExecutor(initializer=init_worker) as pool:
+        for filename, compiled in zip(maps, pool.map(compile_one, maps)):
+            print("{} -> {}".format(path.basename(filename), path.basename(compiled)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -12,10 +12,11 @@ try:
     # System
     import sys
     # Game related
+    import numpy as np
     import pygame as pg
-    import pytweening as tween
     from settings import *
-    from tilemap import collide_hit_rect
+    from fonts import text_cache
+    from store import USED, CALLED
 
     # Aliases
     vec = pg.math.Vector2
@@ -28,61 +29,88 @@ def collide_with_group(sprite, group, dir):
     if sprite.game.noclip:
         return
         
-    hits = pg.sprite.spritecollide(sprite, group, False, collide_hit_rect)
+    hits = sprite.game.view.spatial.query_rect(sprite.hit_rect, group)
     for hit in hits:
         if isinstance(hit, Entity):
             if hit.type == 'door':
                 if hit.open:
                     return
 
+    resolve_collision(sprite, [hit.rect for hit in hits], dir)
+
+def collide_with_walls(sprite, dir):
+    if sprite.game.noclip:
+        return
+
+    resolve_collision(sprite, sprite.game.view.collision.hits(sprite.hit_rect), dir)
+
+def resolve_collision(sprite, hits, dir):
     if dir =='x':
         if hits:
-            if hits[0].rect.centerx > sprite.hit_rect.centerx:
-                sprite.pos.x = hits[0].rect.left - sprite.hit_rect.width / 2
-            if hits[0].rect.centerx < sprite.hit_rect.centerx:
-                sprite.pos.x = hits[0].rect.right + sprite.hit_rect.width / 2
+            if hits[0].centerx > sprite.hit_rect.centerx:
+                sprite.pos.x = hits[0].left - sprite.hit_rect.width / 2
+            if hits[0].centerx < sprite.hit_rect.centerx:
+                sprite.pos.x = hits[0].right + sprite.hit_rect.width / 2
             sprite.vel.x = 0
             sprite.hit_rect.centerx = sprite.pos.x
 
     if dir =='y':
         if hits:
-            if hits[0].rect.centery > sprite.hit_rect.centery:
-                sprite.pos.y = hits[0].rect.top - sprite.hit_rect.height / 2
-            if hits[0].rect.centery < sprite.hit_rect.centery:
-                sprite.pos.y = hits[0].rect.bottom + sprite.hit_rect.height / 2
+            if hits[0].centery > sprite.hit_rect.centery:
+                sprite.pos.y = hits[0].top - sprite.hit_rect.height / 2
+            if hits[0].centery < sprite.hit_rect.centery:
+                sprite.pos.y = hits[0].bottom + sprite.hit_rect.height / 2
             sprite.vel.y = 0
             sprite.hit_rect.centery = sprite.pos.y
 
 class Spritesheet:
-    def __init__(self, filename, tileSize=16, gap=1):
-        self.spritesheet = pg.image.load(filename).convert()
+    # Tiles are sliced from the sheet on first use and kept per size
+    def __init__(self, filename, tileSize=16, gap=1, image=None):
+        # image is the sheet already decoded, by the asset pipeline
+        if image is None:
+            image = pg.image.load(filename)
+        self.spritesheet = image.convert_alpha()
         self.tileSize = tileSize
         self.gap = gap
-        self.tiles = []
-        self.parse_images()
-
-    def parse_images(self):
-        for y in range(int(self.spritesheet.get_height() / self.tileSize)):
-            for x in range(int(self.spritesheet.get_width() / self.tileSize)):
-                offset_x = x * self.tileSize
-                offset_y = y * self.tileSize
+        self.columns = int(self.spritesheet.get_width() / self.tileSize)
+        self.rows = int(self.spritesheet.get_height() / self.tileSize)
+        self.tiles = {}
 
-                if x > 0:
-                    offset_x += self.gap * x
-                if y > 0:
-                    offset_y += self.gap * y
+    def get_offset(self, index):
+        x = index % self.columns
+        y = index // self.columns
+        return x * (self.tileSize + self.gap), y * (self.tileSize + self.gap)
 
-                self.tiles.append(self.make_image(offset_x, offset_y))
-
-    def make_image(self, x, y):
+    def make_image(self, index, size):
         # Grab an image out of a larger spritesheet
-        image = pg.Surface((self.tileSize, self.tileSize), pg.SRCALPHA)
-        image.blit(self.spritesheet, (0, 0), (x, y, self.tileSize, self.tileSize))
-        image = pg.transform.scale(image, (TILE_SIZE, TILE_SIZE))
-        return image
-
-    def get_sprite(self, index):
-        return self.tiles[index]
+        if not 0 <= index < self.columns * self.rows:
+            raise IndexError("Sprite index {} out of the spritesheet".format(index))
+        rect = pg.Rect(self.get_offset(index), (self.tileSize, self.tileSize))
+        if self.spritesheet.get_rect().contains(rect):
+            image = self.spritesheet.subsurface(rect)
+        else:
+            # The last column overflows the sheet, keep the blit's clipping
+            image = pg.Surface((self.tileSize, self.tileSize), pg.SRCALPHA)
+            image.blit(self.spritesheet, (0, 0), rect)
+        return pg.transform.scale(image, size)
+
+    def get_sprite(self, index, size=(TILE_SIZE, TILE_SIZE)):
+        key = (index, size)
+        if key not in self.tiles:
+            self.tiles[key] = self.make_image(index, size)
+        return self.tiles[key]
+
+    def preload(self, indices, size=(TILE_SIZE, TILE_SIZE)):
+        for index in indices:
+            self.get_sprite(index, size)
+
+def sprites_in_use():
+    # Every spritesheet index referenced by the settings
+    indices = {PLAYER_SPRITE, HEART_SPRITE}
+    indices.update(ENTITIES_SPRITES.values())
+    indices.update(MOBS_SPRITES.values())
+    indices.update(ITEM_SPRITES.values())
+    return sorted(indices)
 
 class DialogBox(pg.sprite.Sprite):
     def __init__(self, game, text, pos):
@@ -93,9 +121,7 @@ class DialogBox(pg.sprite.Sprite):
         box_dialog = pg.Surface((WIDTH, HEIGHT/4)).convert_alpha()
         box_dialog.fill((0, 0, 0, 188))
 
-        font = pg.font.Font(self.game.main_font, 24)
-
-        text_surface = font.render(text, 10, WHITE)
+        text_surface = text_cache.render(text, self.game.main_font, 24, WHITE, True)
         text_rect = text_surface.get_rect()
         text_rect.topleft = (10, 10)
 
@@ -168,7 +194,7 @@ class Player(pg.sprite.Sprite):
 
     def get_keys(self):
         self.vel.x, self.vel.y = 0, 0
-        keys = pg.key.get_pressed()
+        keys = self.game.input()
 
         if keys[pg.K_LEFT] or keys[pg.K_q]:
             self.vel.x = -PLAYER_SPEED
@@ -187,14 +213,16 @@ class Player(pg.sprite.Sprite):
         self.rect = self.image.get_rect()
         self.rect.center = self.pos
         self.pos += self.vel * self.game.dt
+        self.game.profiler.mark('update.sprites')
 
         self.hit_rect.centerx = self.pos.x
-        collide_with_group(self, self.game.walls, 'x')
+        collide_with_walls(self, 'x')
         collide_with_group(self, self.game.entities, 'x')
 
         self.hit_rect.centery = self.pos.y
-        collide_with_group(self, self.game.walls, 'y')
+        collide_with_walls(self, 'y')
         collide_with_group(self, self.game.entities, 'y')
+        self.game.profiler.mark('update.collisions')
 
         self.rect.center = self.hit_rect.center
 
@@ -211,28 +239,79 @@ class Player(pg.sprite.Sprite):
         self.health -= dmg
 
     def use_closest_object(self):
-        for entity in self.game.entities:
-            dist = self.pos - entity.pos
-            if 0 < dist.length() < PLAYER_INTERACT_RANGE:
-                entity.use()
-
-class Obstacle(pg.sprite.Sprite):
-    def __init__(self, game, x, y, w, h):
-        self._layer = WALLS_LAYER
-        self.groups = game.view.walls
-        pg.sprite.Sprite.__init__(self, self.groups)
+        # Only the closest entity in reach and in sight gets used
+        entity = self.game.view.spatial.query_nearest(self.pos, PLAYER_INTERACT_RANGE,
+                                                     self.game.entities, self.can_use)
+        if entity:
+            entity.use()
 
-        self.game = game
-        self.rect = pg.Rect(x, y, w, h)
+    def can_use(self, entity):
+        if not entity.usable:
+            return False
+        # Aim for the point of the entity closest to the player, the
+        # walls framing it are only crossed right around it
+        rect = entity.rect
+        x = min(max(self.pos.x, rect.left), rect.right - 1)
+        y = min(max(self.pos.y, rect.top), rect.bottom - 1)
+        return self.game.view.collision.line_of_sight(self.pos, (x, y), rect.inflate(2, 2))
+
+class Record:
+    # A row of the object store, for the objects that are never drawn
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.store is other.store and self.row == other.row
+
+    def __hash__(self):
+        return hash((id(self.store), self.row))
 
-        self.x = x
-        self.y = y
+    @property
+    def name(self):
+        return self.store.name_of(self.row)
 
-        self.rect.x = x
-        self.rect.y = y
+    @property
+    def rect(self):
+        return self.store.rect(self.row)
+
+class Obstacle(Record):
+    __slots__ = ()
+
+class Trigger(Record):
+    __slots__ = ()
+
+    @property
+    def action(self):
+        return TRIGGERS[self.name]['action']
+
+    @property
+    def destination(self):
+        return TRIGGERS[self.name].get('destination')
+
+    @property
+    def event(self):
+        return TRIGGERS[self.name]['event']
+
+    @property
+    def called(self):
+        return self.store.flag(self.row, CALLED)
+
+    @called.setter
+    def called(self, value):
+        self.store.set_flag(self.row, CALLED, value)
+
+class Passage(Record):
+    __slots__ = ()
+
+    @property
+    def pos(self):
+        return int(self.store.x[self.row]), int(self.store.y[self.row])
 
 class Item(pg.sprite.Sprite):
-    def __init__(self, game, pos, name):
+    def __init__(self, game, pos, name, row):
         self._layer = ITEMS_LAYER
         self.groups = game.view.all_sprites, game.view.items
         pg.sprite.Sprite.__init__(self, self.groups)
@@ -242,27 +321,83 @@ class Item(pg.sprite.Sprite):
         self.rect = self.image.get_rect()
         self.hit_rect = self.rect
         self.name = name
+        self.row = row
 
         self.pos = pos
         self.rect.center = pos
 
-        self.tween = tween.easeInOutSine
-        self.step = 0
-        self.dir = 1
+        game.view.spatial.add(self)
+        game.view.bobbing.add(self)
+
+class Bobbing(pg.sprite.AbstractGroup):
+    # Bobbing motion of all the items of a view, stepped together in NumPy.
+    # Items join it like any group and leave it when killed.
+    def __init__(self, spatial):
+        pg.sprite.AbstractGroup.__init__(self)
+        self.spatial = spatial
+        self.members = []
+        self.pending = []
+        self.removed = set()
+
+        self.step = np.zeros(0)
+        self.dir = np.zeros(0)
+        self.base = np.zeros(0)
+        self.centery = np.zeros(0, dtype=int)
+
+    def add_internal(self, sprite, layer=None):
+        pg.sprite.AbstractGroup.add_internal(self, sprite)
+        self.removed.discard(sprite)
+        self.pending.append(sprite)
+
+    def remove_internal(self, sprite):
+        pg.sprite.AbstractGroup.remove_internal(self, sprite)
+        self.removed.add(sprite)
+
+    def flush(self):
+        # Apply the joins and leaves since the last update
+        if self.removed:
+            keep = np.array([sprite not in self.removed for sprite in self.members], dtype=bool)
+            self.members = [sprite for sprite in self.members if sprite not in self.removed]
+            self.pending = [sprite for sprite in self.pending if sprite not in self.removed]
+            self.step = self.step[keep]
+            self.dir = self.dir[keep]
+            self.base = self.base[keep]
+            self.centery = self.centery[keep]
+            self.removed = set()
+
+        if self.pending:
+            count = len(self.pending)
+            self.members += self.pending
+            self.step = np.concatenate((self.step, np.zeros(count)))
+            self.dir = np.concatenate((self.dir, np.ones(count)))
+            self.base = np.concatenate((self.base, [sprite.pos.y for sprite in self.pending]))
+            self.centery = np.concatenate((self.centery, [sprite.rect.centery for sprite in self.pending]))
+            self.pending = []
 
     def update(self):
-        # Bobbing motion
-        # The 0.5 shifting halfway the item because it's moving up and down starting from middle
-        offset = BOB_RANGE * (self.tween(self.step / BOB_RANGE) - 0.5)
-        self.rect.centery = self.pos.y + offset * self.dir
-        self.step += BOB_SPEED
+        self.flush()
+        if not self.members:
+            return
+
+        # easeInOutSine, shifted by 0.5 to move up and down from the middle
+        offset = BOB_RANGE * (-0.5 * (np.cos(np.pi * (self.step / BOB_RANGE)) - 1) - 0.5)
+        y = self.base + offset * self.dir
+        # Rounded the way Rect rounds floats, halves away from zero
+        centery = np.where(y >= 0, np.floor(y + 0.5), np.ceil(y - 0.5)).astype(int)
+
+        for i in np.flatnonzero(centery != self.centery).tolist():
+            sprite = self.members[i]
+            sprite.rect.centery = int(centery[i])
+            self.spatial.move(sprite)
+        self.centery = centery
 
-        if self.step > BOB_RANGE:
-            self.step = 0
-            self.dir *= -1
+        self.step += BOB_SPEED
+        over = self.step > BOB_RANGE
+        self.step[over] = 0
+        self.dir[over] *= -1
 
 class Mob(pg.sprite.Sprite):
-    def __init__(self, game, pos, name):
+    def __init__(self, game, pos, name, row):
         self._layer = MOBS_LAYER
         self.groups = game.view.all_sprites, game.view.mobs
         pg.sprite.Sprite.__init__(self, self.groups)
@@ -271,14 +406,45 @@ class Mob(pg.sprite.Sprite):
         self.image = game.mobs_images[name]
         self.rect = self.image.get_rect()
         self.rect.center = pos
-        self.hit_rect = self.rect
+        self.hit_rect = MOB_HIT_RECT.copy()
+        self.hit_rect.center = self.rect.center
 
         self.name = name
+        self.row = row
 
+        self.vel = vec(0, 0)
         self.pos = vec(pos[0], pos[1])
 
+        game.view.spatial.add(self)
+
+    def update(self):
+        # Follow the view's flow field towards the player
+        self.vel = vec(0, 0)
+        tile = self.game.view.flow.next_tile(self.pos)
+        if tile is not None:
+            if tile == self.game.view.flow.target:
+                target = self.game.player.pos
+            else:
+                # Aim for the middle of the next tile to stay clear of corners
+                target = vec((tile[0] + 0.5) * TILE_SIZE, (tile[1] + 0.5) * TILE_SIZE)
+            if self.pos.distance_to(self.game.player.pos) > MOB_STOP_RANGE:
+                offset = target - self.pos
+                if offset.length_squared() > 0:
+                    self.vel = offset.normalize() * MOB_SPEED
+
+        if self.vel.length_squared() == 0:
+            return
+
+        self.pos += self.vel * self.game.dt
+        self.hit_rect.centerx = self.pos.x
+        resolve_collision(self, self.game.view.collision.hits(self.hit_rect), 'x')
+        self.hit_rect.centery = self.pos.y
+        resolve_collision(self, self.game.view.collision.hits(self.hit_rect), 'y')
+        self.rect.center = self.hit_rect.center
+        self.game.view.spatial.move(self)
+
 class Entity(pg.sprite.Sprite):
-    def __init__(self, game, pos, name):
+    def __init__(self, game, pos, name, row):
         self._layer = ENTITIES_LAYER
         self.groups = game.view.all_sprites, game.view.entities
         pg.sprite.Sprite.__init__(self, self.groups)
@@ -294,61 +460,39 @@ class Entity(pg.sprite.Sprite):
         if self.type == 'chest':
             self.inventory = ENTITIES[name]['inventory']
 
-        self.open = False
+        # Door and chest state lives in the view's object store
+        self.store = game.view.store
+        self.row = row
         
         self.pos = pos
 
         self.rect.x = pos[0]
         self.rect.y = pos[1]
 
+        game.view.spatial.add(self)
+
+    @property
+    def open(self):
+        return self.type == 'door' and self.store.flag(self.row, USED)
+
+    @property
+    def usable(self):
+        # Doors open and chests empty only once
+        return not self.store.flag(self.row, USED)
+
     def use(self):
         if self.key != '':
             if not self.game.player.has(self.key):
                 return
 
         self.image = self.game.entities_images[self.name][1]
+        self.store.set_flag(self.row, USED)
+        self.store.sprite[self.row] = ENTITIES[self.name]['sprite2']
         if self.type == 'chest':
             self.game.player.give(self.inventory)
             self.inventory = []
         if self.type == 'door':
-            self.open = True
-
-class Trigger(pg.sprite.Sprite):
-    def __init__(self, game, pos, w, h, name):
-        self._layer = TRIGGERS_LAYER
-        self.groups = game.view.triggers
-        pg.sprite.Sprite.__init__(self, self.groups)
-        self.game = game
-        
-        self.rect = pg.Rect(pos[0], pos[1], w, h)
-
-        self.name = name
-        self.destination = None
-
-        self.action = TRIGGERS[name]['action']
-        if self.action == 'teleport':
-            self.destination = TRIGGERS[name]['destination']
-        if self.action == 'event':
-            self.event = TRIGGERS[name]['event']
-            self.called = False
-
-        self.rect.x = pos[0]
-        self.rect.y = pos[1]
-
-class Passage(pg.sprite.Sprite):
-    def __init__(self, game, pos, w, h, name):
-        self._layer = PASSAGES_LAYER
-        self.groups = game.view.passages
-        pg.sprite.Sprite.__init__(self, self.groups)
-        self.game = game
-        
-        self.rect = pg.Rect(pos[0], pos[1], w, h)
-
-        self.name = name
-
-        self.pos = pos
-        self.rect.x = pos[0]
-        self.rect.y = pos[1]
+            self.game.view.flow.open_door(self)
 
 class Camera:
     def __init__(self, width, height):
@@ -362,6 +506,10 @@ class Camera:
     def apply_rect(self, rect):
         return rect.move(self.camera.topleft)
 
+    def get_view(self):
+        # The part of the map seen on screen
+        return pg.Rect(-self.camera.x, -self.camera.y, WIDTH, HEIGHT)
+
     def update(self, target):
         x = -target.rect.centerx + int(WIDTH / 2)
         y = -target.rect.centery + int(HEIGHT / 2)
@@ -0,0 +1,72 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# fonts.py                                          #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import sys
+    from collections import OrderedDict
+    # Game related
+    import pygame as pg
+    from settings import *
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        self.misses += 1
+        value = make()
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def stats(self):
+        return {'size': len(self.items), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+class FontCache(LRUCache):
+    # pg.font.Font objects keyed by (path, size)
+    def font(self, path, size):
+        return self.get((path, size), lambda: pg.font.Font(path, size))
+
+class TextCache(LRUCache):
+    # Rendered text surfaces keyed by (text, font, size, color, antialias)
+    def __init__(self, max_size, fonts):
+        LRUCache.__init__(self, max_size)
+        self.fonts = fonts
+
+    def render(self, text, path, size, color, antialias=True):
+        key = (text, path, size, tuple(color), bool(antialias))
+        return self.get(key, lambda: self.fonts.font(path, size).render(text, antialias, color))
+
+font_cache = FontCache(FONT_CACHE_SIZE)
+text_cache = TextCache(TEXT_CACHE_SIZE, font_cache)
@@ -15,11 +15,21 @@ try:
     import sys
     from os import path
     from os import listdir
+    from time import perf_counter
+    from collections import OrderedDict
     # Game related
+    import numpy as np
     import pygame as pg
     from settings import *
-    from tilemap import TiledMap
+    from tilemap import MapRegistry, Prefetcher, CollisionGrid, SpatialHash, open_map
+    from assets import AssetPipeline, read_text
+    from pathfinding import FlowField
+    from store import ObjectStore, TriggerCells, ViewState, WALL, TRIGGER, PASSAGE, ENTITY, ITEM, MOB
     from entities import *
+    from fonts import text_cache
+    from profiler import FrameProfiler
+    from save import SaveWriter, read_save, saved_map, state_of
+    from replay import Recorder
 
     # Aliases
     vec = pg.math.Vector2
@@ -31,12 +41,11 @@ except ImportError as err:
 class View:
     def __init__(self, game, map, dimensions):
         self.game           = game
-        self.map            = TiledMap(path.join(game.maps_folder, map))
-        self.map_img        = self.map.make_map()
-        self.map_rect       = self.map_img.get_rect()
+        self.map            = game.maps.get(map)
+        self.map_rect       = pg.Rect(0, 0, self.map.width, self.map.height)
 
         self.dimensions     = dimensions
-        self.screen         = pg.display.set_mode(self.dimensions)
+        self.screen         = pg.display.get_surface()
 
         self.all_sprites    = game.all_sprites
         self.walls          = game.walls
@@ -45,17 +54,197 @@ class View:
         self.mobs           = game.mobs
         self.triggers       = game.triggers
         self.passages       = game.passages
+        self.spatial        = game.spatial
+        self.bobbing        = game.bobbing
+        self.store          = game.store
+
+    def get_size(self):
+        # Bytes held by the baked map and the view's arrays,
+        # sprites and parsed map data are not counted
+        size = self.map.get_size()
+        size += sum(getattr(self.store, column).nbytes for column in ('id', 'kind', 'name', 'x', 'y',
+                                                                      'w', 'h', 'sprite', 'flags'))
+        size += self.collision.solid.nbytes + self.collision.index.nbytes
+        size += self.flow.walls.nbytes + self.flow.doors.nbytes + self.flow.dist.nbytes
+        return size
+
+class ViewCache:
+    # The views visited or prefetched, most recently used last. When their
+    # size goes over the budget the oldest are dropped with their map,
+    # keeping only their dynamic state, and rebuilt when needed again.
+    def __init__(self, game, budget=VIEW_CACHE_BUDGET):
+        self.game = game
+        self.budget = budget
+        self.views = OrderedDict()
+        self.states = {}
+        self.evictions = 0
+        self.restores = 0
+
+    def __contains__(self, name):
+        return name in self.views
+
+    def __getitem__(self, name):
+        return self.views[name]
+
+    def __setitem__(self, name, view):
+        if name in self.states:
+            self.restore(view, self.states.pop(name))
+        self.views[name] = view
+        self.views.move_to_end(name)
+        self.evict()
+
+    def get(self, name):
+        if name in self.views:
+            self.views.move_to_end(name)
+            # The registry may have let go of the map the view still uses
+            if name not in self.game.maps:
+                self.game.maps.add(name, self.views[name].map)
+        else:
+            self[name] = self.game.make_view(name)
+        return self.views[name]
+
+    def evict(self):
+        # Neither the current view nor the latest one are evicted
+        for name in list(self.views)[:-1]:
+            if self.get_size() <= self.budget:
+                break
+            if self.views[name] is self.game.view:
+                continue
+            view = self.views.pop(name)
+            self.states[name] = self.snapshot(view)
+            # Its baked chunks and parsed map go with it
+            view.map.chunks.clear()
+            self.game.maps.discard(name)
+            self.evictions += 1
+
+    def get_size(self):
+        return sum(self.sizes().values())
+
+    def sizes(self):
+        # Bytes per view, maps shared by several views count for each
+        return {name: view.get_size() for name, view in self.views.items()}
+
+    def snapshot(self, view):
+        store = view.store
+        ids = store.id.tolist()
+        inventories = {ids[entity.row]: list(entity.inventory) for entity in view.entities
+                       if entity.type == 'chest'}
+        mobs = np.array([(ids[mob.row], mob.pos.x, mob.pos.y) for mob in view.mobs]).reshape(-1, 3)
+        alive = set(item.row for item in view.items)
+        removed = np.array([ids[row] for row in np.flatnonzero(store.kind == ITEM).tolist()
+                            if row not in alive], dtype=np.int32)
+
+        bobbing = view.bobbing
+        bobbing.flush()
+        members = np.array([ids[item.row] for item in bobbing.members], dtype=np.int32)
+        return ViewState(store.id.copy(), store.kind.copy(), store.flags.copy(), inventories, mobs, removed,
+                         (members, bobbing.step.copy(), bobbing.dir.copy(), bobbing.centery.copy()))
+
+    def restore(self, view, state):
+        # Objects are matched by Tiled id, the ones the state
+        # doesn't know about keep their state from the map
+        store = view.store
+        self.restores += 1
+        rows = {key: row for row, key in enumerate(zip(store.id.tolist(), store.kind.tolist()))}
+        for key, flags in zip(zip(state.ids.tolist(), state.kinds.tolist()), state.flags.tolist()):
+            if key in rows:
+                store.flags[rows[key]] = flags
+
+        ids = store.id.tolist()
+        for entity in view.entities:
+            if not entity.usable:
+                entity.image = self.game.entities_images[entity.name][1]
+                store.sprite[entity.row] = ENTITIES[entity.name]['sprite2']
+            if entity.open:
+                view.flow.open_door(entity)
+            if entity.type == 'chest' and ids[entity.row] in state.inventories:
+                entity.inventory = list(state.inventories[ids[entity.row]])
+
+        positions = {int(id): (x, y) for id, x, y in state.mobs.tolist()}
+        for mob in view.mobs:
+            if ids[mob.row] in positions:
+                mob.pos = vec(positions[ids[mob.row]])
+                mob.hit_rect.center = mob.pos
+                mob.rect.center = mob.hit_rect.center
+                view.spatial.move(mob)
+
+        removed = set(state.removed.tolist())
+        for item in view.items.sprites():
+            if ids[item.row] in removed:
+                item.kill()
+
+        if state.bobbing is None:
+            return
+        members, step, dir, centery = state.bobbing
+        bobbing = view.bobbing
+        bobbing.flush()
+        index = {ids[item.row]: i for i, item in enumerate(bobbing.members)}
+        for id, item_step, item_dir, item_centery in zip(members.tolist(), step, dir, centery.tolist()):
+            if id in index:
+                i = index[id]
+                bobbing.step[i] = item_step
+                bobbing.dir[i] = item_dir
+                bobbing.centery[i] = item_centery
+                bobbing.members[i].rect.centery = item_centery
+                view.spatial.move(bobbing.members[i])
+
+class ViewBuilder:
+    # Builds a view a slice at a time, so a prefetched map doesn't stall
+    # a whole frame. The view under construction is only made the game's
+    # current one while a slice runs.
+    def __init__(self, game, map_name):
+        self.game = game
+        self.map_name = map_name
+        self.view = None
+        self.steps = self.build()
+
+    def build(self):
+        game = self.game
+        game.reset_groups()
+        game.view = View(game, self.map_name, game.dimensions)
+        yield
+        yield from game.load_map_steps()
+
+    def run(self, budget=None):
+        # Works for budget seconds at most, returns the view once it is
+        # built and None while there is work left
+        game = self.game
+        current = game.view
+        if self.view is not None:
+            game.view = self.view
+            game.load_groups()
+        try:
+            deadline = perf_counter() + budget if budget is not None else None
+            for step in self.steps:
+                self.view = game.view
+                if deadline is not None and perf_counter() >= deadline:
+                    return None
+            self.view = game.view
+            return self.view
+        finally:
+            game.view = current
+            game.load_groups()
 
 class Game:
-    def __init__(self):
+    def __init__(self, render_mode=RENDER_MODE):
+        self.started = perf_counter()
+        self.first_frame = None
         pg.init()
         self.dimensions = (WIDTH, HEIGHT)
         self.screen = pg.display.set_mode(self.dimensions)
 
         self.clock = pg.time.Clock()
 
-        self.maps = {}
-        self.views = {}
+        self.render_mode = render_mode
+        # Held keys, swapped for a scripted source when running headless
+        self.input = pg.key.get_pressed
+        # Set to a Recorder to record the input of a new game
+        self.recorder = None
+        self.profiler = FrameProfiler()
+        # Fixed simulation step
+        self.dt = 1 / SIM_RATE
+        self.last_drawn = {}
+        self.last_state = None
 
         pg.display.set_caption(TITLE)
 
@@ -70,28 +259,52 @@ class Game:
         
         self.fonts_folder = path.join(self.assets_folder, 'fonts')
         
-        self.spritesheet = Spritesheet(path.join(self.assets_folder, SPRITESHEET))
-
-        self.player_img = self.spritesheet.get_sprite(PLAYER_SPRITE)
-        self.lifebar_img = self.spritesheet.get_sprite(HEART_SPRITE)
-
         self.main_font = path.join(self.fonts_folder, MAIN_FONT)
+        self.second_font = path.join(self.fonts_folder, SECOND_FONT)
 
         self.dim_screen = pg.Surface(self.screen.get_size()).convert_alpha()
         self.dim_screen.fill((0, 0, 0, 188))
 
-        maps = [f for f in listdir(path.join(self.maps_folder)) if path.isfile(path.join(path.join(self.maps_folder), f))]
-        for map_name in maps:
-            if '.tmx' in map_name:
-                map = TiledMap(path.join(self.maps_folder, map_name))
-                map_img = map.make_map()
-                map_rect = map_img.get_rect()
-                self.maps[map_name] = (map, map_img, map_rect)
+        self.maps = MapRegistry(self.maps_folder)
+        self.prefetcher = Prefetcher(self)
+        self.saves_folder = path.join(self.game_folder, SAVE_FOLDER)
+        self.saves = SaveWriter(self.saves_folder)
+        # Off for headless runs and benchmarks
+        self.autosaving = True
+
+        # Decoding, parsing and reading go to a thread pool,
+        # the finish steps below run here on the main thread
+        assets = AssetPipeline()
+        assets.add(SPRITESHEET, pg.image.load, self.load_sprites, path.join(self.assets_folder, SPRITESHEET))
+        # Only the map the game starts on, the registry and the prefetcher
+        # load the others when they are needed
+        start_map = saved_map(self.saves_folder)
+        if start_map not in MAPS:
+            start_map = MAPS[1]
+        assets.add(start_map, open_map, lambda map: self.maps.add(start_map, map),
+                   path.join(self.maps_folder, start_map), False)
+
+        texts = [f for f in listdir(path.join(self.texts_folder))
+                 if path.isfile(path.join(path.join(self.texts_folder), f)) and '.txt' in f]
+        self.all_texts = [""] * len(texts)
+        for i, file in enumerate(texts):
+            assets.add(file, read_text, lambda text, i=i: self.all_texts.__setitem__(i, text),
+                       path.join(self.texts_folder, file))
+
+        assets.run(self.draw_loading)
+        self.load_time = perf_counter() - self.started
+
+    def load_sprites(self, sheet):
+        self.spritesheet = Spritesheet(path.join(self.assets_folder, SPRITESHEET), image=sheet)
+        self.spritesheet.preload(sprites_in_use())
+
+        self.player_img = self.spritesheet.get_sprite(PLAYER_SPRITE)
+        self.lifebar_img = self.spritesheet.get_sprite(HEART_SPRITE)
 
         self.item_images = {}
         for item in ITEM_SPRITES:
-            temp_image = self.spritesheet.get_sprite(ITEM_SPRITES[item])
-            self.item_images[item] = pg.transform.scale(temp_image, (TILE_SIZE - int(TILE_SIZE/8), TILE_SIZE - int(TILE_SIZE/8)))
+            size = (TILE_SIZE - int(TILE_SIZE/8), TILE_SIZE - int(TILE_SIZE/8))
+            self.item_images[item] = self.spritesheet.get_sprite(ITEM_SPRITES[item], size)
 
         self.mobs_images = {}
         for mob in MOBS:
@@ -102,46 +315,66 @@ class Game:
             sprite1 = self.spritesheet.get_sprite(ENTITIES[entity]['sprite1'])
             sprite2 = self.spritesheet.get_sprite(ENTITIES[entity]['sprite2'])
             self.entities_images[entity] = (sprite1, sprite2)
-        
-        self.all_texts = []
-        texts = [f for f in listdir(path.join(self.texts_folder)) if path.isfile(path.join(path.join(self.texts_folder), f))]
-        for file in texts:
-            text = ""
-            if '.txt' in file:
-                file_text = open(path.join(self.texts_folder, file), 'r')
-                for line in file_text.readlines():
-                    text += line.strip()
-                self.all_texts.append(text)
-
-    def new(self):
+
+    def draw_loading(self, assets):
+        pg.event.pump()
+        self.screen.fill(BLACK)
+        self.draw_text("Loading...", self.main_font, 75, WHITE, WIDTH / 2, HEIGHT / 2 - 60, align='center', dest=self.screen)
+        bar = pg.Rect(0, 0, WIDTH / 2, 24)
+        bar.center = (WIDTH / 2, HEIGHT / 2 + 20)
+        pg.draw.rect(self.screen, WHITE, bar, 2)
+        pg.draw.rect(self.screen, WHITE, (bar.x, bar.y, bar.width * assets.progress(), bar.height))
+        self.draw_text(assets.current, self.second_font, 20, WHITE, WIDTH / 2, bar.bottom + 20, align='center', dest=self.screen)
+        pg.display.flip()
+
+    def new(self, map_name=MAPS[1]):
         # Initialization and setup
         self.reset_groups()
         self.gui = pg.sprite.Group()
+        self.views = ViewCache(self)
 
-        self.current_map = MAPS[1]
+        self.current_map = map_name
         self.view = View(self, self.current_map, self.dimensions)
-        self.views[self.current_map] = self.view
 
         self.player_spawned = False
         self.zone = None
 
         self.load_map()
+        self.views[self.current_map] = self.view
+
+        self.lifebar = Lifebar(self, 10, 10)
+        self.camera = Camera(self.view.map.width, self.view.map.height)
+        self.paused = False
+
+        self.prefetcher.request(self.current_map)
 
         self.show_dialog = False
         self.show_gui = True
         
         self.draw_debug = False
+        self.draw_stats = {'drawn': 0, 'culled': 0, 'dirty': None}
+        self.last_state = None
+        self.previous = {}
+        self.previous_camera = None
+        self.alpha = 1
         self.noclip = False
+        self.save_timer = 0
+        # The first save of a game is a full one
+        self.full_save_due = True
 
     def reset_groups(self):
+        # Walls, triggers and passages are never drawn,
+        # they only exist as rows of the object store
+        self.store          = ObjectStore()
         self.all_sprites    = pg.sprite.LayeredUpdates()
-        self.gui            = pg.sprite.Group()
-        self.walls          = pg.sprite.Group()
+        self.walls          = self.store.group(WALL, Obstacle)
         self.items          = pg.sprite.Group()
         self.entities       = pg.sprite.Group()
         self.mobs           = pg.sprite.Group()
-        self.triggers       = pg.sprite.Group()
-        self.passages       = pg.sprite.Group()
+        self.triggers       = self.store.group(TRIGGER, Trigger)
+        self.passages       = self.store.group(PASSAGE, Passage)
+        self.spatial        = SpatialHash()
+        self.bobbing        = Bobbing(self.spatial)
 
     def load_groups(self):
         self.all_sprites    = self.view.all_sprites
@@ -151,51 +384,93 @@ class Game:
         self.mobs           = self.view.mobs
         self.triggers       = self.view.triggers
         self.passages       = self.view.passages
+        self.spatial        = self.view.spatial
+        self.bobbing        = self.view.bobbing
+        self.store          = self.view.store
 
     def load_map(self):
-        for tile_object in self.view.map.tmxdata.objects:
-
-                tile_object.x *= int(TILE_SIZE / self.view.map.tilesize)
-                tile_object.y *= int(TILE_SIZE / self.view.map.tilesize)
-
-                obj_center = vec(tile_object.x + tile_object.width / 2 + 12, tile_object.y + tile_object.height / 2 + 12)
+        # All at once, ViewBuilder spreads it over several frames
+        for step in self.load_map_steps():
+            pass
+
+    def load_map_steps(self):
+        # Loads the map of self.view, yielding between slices of the work
+        scale = int(TILE_SIZE / self.view.map.tilesize)
+        for i, tile_object in enumerate(self.view.map.objects):
+                if i % VIEW_BUILD_BATCH == VIEW_BUILD_BATCH - 1:
+                    yield
+
+                # The tmx objects are shared through the map registry,
+                # so scale copies of their coordinates instead of the objects
+                x = tile_object.x * scale
+                y = tile_object.y * scale
+                width = tile_object.width
+                height = tile_object.height
+
+                obj_center = vec(x + width / 2 + 12, y + height / 2 + 12)
                 # I still can't figure out why I have to 
                 # hard-code an offset of 12 pixels for the positions of the entities.
 
-                if tile_object.name == 'player_start' and not self.player_spawned:
+                name = tile_object.name
+                store = self.view.store
+
+                if name == 'player_start' and not self.player_spawned:
                     self.player = Player(self, obj_center)
                     self.player_spawned = True
 
-                elif tile_object.name in ITEMS:
-                    Item(self, obj_center, tile_object.name)
+                elif name in ITEMS:
+                    row = store.add(ITEM, tile_object.id, name, self.object_rect(x, y, width, height),
+                                    ITEM_SPRITES.get(name, -1))
+                    Item(self, obj_center, name, row)
 
-                elif tile_object.name in MOBS:
-                    Mob(self, obj_center, tile_object.name)
+                elif name in MOBS:
+                    row = store.add(MOB, tile_object.id, name, self.object_rect(x, y, width, height),
+                                    MOBS[name]['sprite'])
+                    Mob(self, obj_center, name, row)
 
                 else:
-                    tile_object.width *= int(TILE_SIZE / self.view.map.tilesize)
-                    tile_object.height *= int(TILE_SIZE / self.view.map.tilesize)
+                    width *= scale
+                    height *= scale
 
-                if tile_object.name in ENTITIES:
-                    pos = (tile_object.x, tile_object.y)
-                    Entity(self, pos, tile_object.name)
+                rect = self.object_rect(x, y, width, height)
 
-                if tile_object.name in TRIGGERS:
-                    pos = (tile_object.x, tile_object.y)
-                    Trigger(self, pos, tile_object.width, tile_object.height, tile_object.name)
+                if name in ENTITIES:
+                    pos = (x, y)
+                    row = store.add(ENTITY, tile_object.id, name, rect, ENTITIES[name]['sprite1'])
+                    Entity(self, pos, name, row)
 
-                if tile_object.name in PASSAGES:
-                    pos = (tile_object.x, tile_object.y)
-                    PASSAGES[tile_object.name]['x'] = tile_object.x
-                    PASSAGES[tile_object.name]['y'] = tile_object.y
-                    Passage(self, pos, tile_object.width, tile_object.height, tile_object.name)
+                if name in TRIGGERS:
+                    store.add(TRIGGER, tile_object.id, name, rect)
 
-                if tile_object.name == 'wall':
-                    Obstacle(self, tile_object.x, tile_object.y, tile_object.width, tile_object.height)
+                if name in PASSAGES:
+                    PASSAGES[name]['x'] = x
+                    PASSAGES[name]['y'] = y
+                    store.add(PASSAGE, tile_object.id, name, rect)
 
-        self.lifebar = Lifebar(self, 10, 10)
-        self.camera = Camera(self.view.map.width, self.view.map.height)
-        self.paused = False
+                if name == 'wall':
+                    store.add(WALL, tile_object.id, name, rect)
+
+        self.view.store.freeze()
+        self.view.trigger_cells = TriggerCells(self.view.triggers)
+        yield
+        walls = [wall.rect for wall in self.view.walls]
+        self.view.collision = CollisionGrid(self.view.map.width, self.view.map.height, walls)
+        yield
+        self.view.flow = FlowField(self.view.map.tiles_x, self.view.map.tiles_y, self.view.collision, self.view.entities)
+
+    def object_rect(self, x, y, width, height):
+        # Sizes truncate and positions round, as the sprites' rects used to
+        rect = pg.Rect(0, 0, width, height)
+        rect.x = x
+        rect.y = y
+        return rect
+
+    def make_view(self, map_name):
+        # Build a view and its sprites, leaving the current view active
+        return ViewBuilder(self, map_name).run()
+
+    def view_builder(self, map_name):
+        return ViewBuilder(self, map_name)
 
     def call_event(self, event):
         if event == 0:
@@ -207,46 +482,134 @@ class Game:
     def run(self):
         # Game loop
         self.playing = True
+        self.dt = 1 / SIM_RATE
+        self.accumulator = 0
         while self.playing:
-            self.dt = self.clock.tick(FPS) / 1000
+            frame_time = self.clock.tick(FPS) / 1000
+            self.profiler.begin()
             self.events()
+            self.profiler.mark('events')
             if not self.paused:
-                self.update()
+                self.step(frame_time)
             self.draw()
+            self.profiler.end()
+
+            if self.first_frame is None:
+                self.first_frame = perf_counter() - self.started
+                print("Assets loaded in {:.2f}s, first frame after {:.2f}s".format(self.load_time, self.first_frame))
+
+    def step(self, frame_time):
+        # Run as many fixed updates as the elapsed time allows
+        self.accumulator += frame_time
+        steps = 0
+        while self.accumulator >= self.dt and steps < MAX_SIM_STEPS:
+            self.snapshot()
+            self.update()
+            self.accumulator -= self.dt
+            steps += 1
+
+        if self.accumulator >= self.dt:
+            # Too far behind, drop the backlog rather than spiral
+            self.accumulator = 0
+        self.alpha = self.accumulator / self.dt
+
+    def snapshot(self):
+        # Positions before an update, to interpolate the drawing
+        self.previous = {sprite: sprite.rect.topleft for sprite in self.visible_sprites()}
+        self.previous_camera = self.camera.camera.topleft
 
     def quit(self):
+        if self.recorder:
+            self.recorder.save()
+        if self.autosaving:
+            self.saves.wait()
+            self.save(full=True)
+            self.saves.wait()
         pg.quit()
         sys.exit()
 
+    def save(self, full=False):
+        # Only snapshots are taken here, the save thread does the rest
+        states = dict(self.views.states)
+        for name, view in self.views.views.items():
+            states[name] = self.views.snapshot(view)
+        player = (self.current_map, self.player.pos.x, self.player.pos.y,
+                  self.player.health, list(self.player.inventory))
+
+        if self.saves.request(player, states, full or self.full_save_due):
+            self.full_save_due = False
+            self.save_timer = 0
+
+    def load_game(self):
+        # Rebuilds the saved game on top of a fresh one,
+        # returns False when there is nothing to load
+        try:
+            saved = read_save(self.saves_folder)
+        except (OSError, ValueError) as err:
+            print("Couldn't load the save: {}".format(err))
+            return False
+        if saved is None:
+            return False
+
+        (map_name, x, y, health, inventory), maps = saved
+        self.new(map_name)
+        for name, map_records in maps.items():
+            if name == self.current_map:
+                self.views.restore(self.view, state_of(map_records))
+            else:
+                self.views.states[name] = state_of(map_records)
+
+        if not self.player_spawned:
+            # Saved on a map without a player start
+            self.player = Player(self, (x, y))
+            self.player_spawned = True
+        self.player.pos = vec(x, y)
+        self.player.hit_rect.center = self.player.pos
+        self.player.rect.center = self.player.hit_rect.center
+        self.player.health = health
+        self.player.inventory = inventory
+        self.view.trigger_cells.reset(self.player.hit_rect)
+        return True
+
     def update(self):
         # Update portion of the game loop
+        if self.recorder:
+            self.recorder.tick()
+        self.prefetcher.poll()
+
+        if self.autosaving:
+            self.save_timer += self.dt
+            if self.save_timer >= AUTOSAVE_INTERVAL:
+                self.save()
+
+        self.view.flow.update(self.player.pos)
         self.view.all_sprites.update()
+        self.view.bobbing.update()
         self.gui.update()
         self.camera.update(self.player)
+        self.profiler.mark('update.sprites')
 
-        triggers = pg.sprite.spritecollide(self.player, self.triggers, False, collide_hit_rect)
-        for trigger in triggers:
+        # Triggers only fire when the player steps into them
+        entered, left = self.view.trigger_cells.update(self.player.hit_rect)
+        for trigger in entered:
             if trigger.action == 'teleport':
                 self.travel_to(trigger.destination)
             if trigger.action == 'event':
                 if not trigger.called:
                     self.call_event(trigger.event)
                     trigger.called = True
+        self.profiler.mark('update.triggers')
 
     def travel_to(self, dest):
         dest_map = PASSAGES[dest]['location']
         self.views[self.current_map] = self.view
 
         if dest_map not in self.views:
-            self.reset_groups()
-            self.view = View(self, dest_map, self.dimensions)
-            self.view.all_sprites.add(self.player)
-            self.load_map()
-
-        else:
-            self.view = self.views[dest_map]
-
+            self.prefetcher.wait(dest_map)
+        self.view = self.views.get(dest_map)
+        self.view.all_sprites.add(self.player)
         self.load_groups()
+        self.camera = Camera(self.view.map.width, self.view.map.height)
 
         self.current_map = dest_map
         dest_pos = vec(PASSAGES[dest]['x'], PASSAGES[dest]['y'])
@@ -254,9 +617,19 @@ class Game:
         self.player.vel = vec(0, 0)
         self.player.pos = dest_pos
 
+        # Arriving on a trigger doesn't count as entering it
+        arrival = self.player.hit_rect.copy()
+        arrival.center = dest_pos
+        self.view.trigger_cells.reset(arrival)
+
+        # Nothing to interpolate from on the new map
+        self.previous = {}
+        self.previous_camera = None
+
+        self.prefetcher.request(dest_map)
+
     def draw_text(self, text, font_name, size, color, x, y, align="nw", dest=None):
-        font = pg.font.Font(font_name, size)
-        text_surface = font.render(text, True, color)
+        text_surface = text_cache.render(text, font_name, size, color, True)
         text_rect = text_surface.get_rect()
         if align == "nw":
             text_rect.topleft = (x, y)
@@ -288,35 +661,91 @@ class Game:
         for y in range(0, HEIGHT, TILE_SIZE):
             pg.draw.line(self.screen, LIGHT_GREY, (0, y), (WIDTH, y))
 
+    def visible_sprites(self, area=None):
+        # Sprites intersecting the camera (or a part of the screen),
+        # in layer order with the player on top
+        if area is None:
+            view = self.camera.get_view()
+        else:
+            view = area.move(-self.camera.camera.x, -self.camera.camera.y)
+        sprites = self.view.spatial.query_rect(view, self.all_sprites)
+        sprites.sort(key=self.all_sprites.get_layer_of_sprite)
+        if self.player.rect.colliderect(view):
+            sprites.append(self.player)
+
+        if area is None:
+            self.draw_stats['drawn'] = len(sprites)
+            self.draw_stats['culled'] = len(self.all_sprites) - len(sprites)
+        return sprites
+
+    def gui_rect(self, ui):
+        if isinstance(ui, Lifebar):
+            return ui.image.get_rect(topleft=(10, 10))
+        if isinstance(ui, DialogBox):
+            return ui.image.get_rect(topleft=(0, HEIGHT * 3/4))
+
+    def lerp(self, previous, current):
+        return (round(previous[0] + (current[0] - previous[0]) * self.alpha),
+                round(previous[1] + (current[1] - previous[1]) * self.alpha))
+
+    def draw_rect(self, sprite):
+        # Screen rect of a sprite, between its last two simulated positions
+        rect = sprite.rect
+        previous = self.previous.get(sprite)
+        if previous is not None and self.alpha < 1:
+            rect = rect.copy()
+            rect.topleft = self.lerp(previous, rect.topleft)
+        return self.camera.apply_rect(rect)
+
     def draw(self):
-        # Draw stuff here
+        self.view.map.animate(pg.time.get_ticks())
+        camera = self.camera.camera
+        if self.previous_camera is not None and self.alpha < 1:
+            self.camera.camera = camera.copy()
+            self.camera.camera.topleft = self.lerp(self.previous_camera, camera.topleft)
+
+        if self.render_mode == 'dirty':
+            self.draw_dirty()
+        else:
+            self.draw_scene()
+            pg.display.flip()
+            self.profiler.mark('flip')
+        self.screen = self.view.screen
+        self.camera.camera = camera
+        # Drawing bakes chunks, the map budget is checked after it
+        self.maps.evict(keep=(self.current_map,))
+
+    def draw_scene(self, area=None):
+        # Draw stuff here, clipped to area when given
+        self.view.screen.set_clip(area)
         self.view.screen.fill(BG_COLOR)
-        self.view.screen.blit(self.view.map_img, self.camera.apply_rect(self.view.map_rect))
+        self.view.map.draw(self.view.screen, self.camera)
         # self.draw_grid()
+        self.profiler.mark('draw.map')
 
-        for sprite in self.all_sprites:
-            if isinstance(sprite, Player):
-                self.view.all_sprites.move_to_front(sprite)
-
-            self.view.screen.blit(sprite.image, self.camera.apply(sprite))
+        for sprite in self.visible_sprites(area):
+            self.view.screen.blit(sprite.image, self.draw_rect(sprite))
 
             if self.draw_debug:
                 pg.draw.rect(self.view.screen, CYAN, self.camera.apply_rect(sprite.hit_rect), 1)
+        self.profiler.mark('draw.sprites')
         
         for ui in self.gui:
-            if isinstance(ui, Lifebar):
-                self.screen.blit(ui.image, (10, 10))
-            if isinstance(ui, DialogBox):
-                self.screen.blit(ui.image, (0, HEIGHT * 3/4))
+            rect = self.gui_rect(ui)
+            if rect:
+                self.view.screen.blit(ui.image, rect)
 
         if self.draw_debug:
-            pg.display.set_caption("{:.2f}".format(self.clock.get_fps()))
-            
-            for wall in self.walls:
-                pg.draw.rect(self.view.screen, YELLOW, self.camera.apply_rect(wall.rect), 1)
-            for trigger in self.triggers:
+            pg.display.set_caption("{:.2f} - {} drawn, {} culled - {} views, {:.1f} MB, {} evicted".format(
+                self.clock.get_fps(), self.draw_stats['drawn'], self.draw_stats['culled'],
+                len(self.views.views), self.views.get_size() / 2**20, self.views.evictions))
+
+            view = self.camera.get_view()
+            for wall in self.view.collision.hits(view):
+                pg.draw.rect(self.view.screen, YELLOW, self.camera.apply_rect(wall), 1)
+            for trigger in self.triggers.query_rect(view):
                 pg.draw.rect(self.view.screen, RED, self.camera.apply_rect(trigger.rect), 1)
-            for passage in self.passages:
+            for passage in self.passages.query_rect(view):
                 pg.draw.rect(self.view.screen, GREEN, self.camera.apply_rect(passage.rect), 1)
 
         else:
@@ -329,28 +758,90 @@ class Game:
         if self.noclip:
             self.draw_text("NOCLIP", self.main_font, 70, WHITE, WIDTH/10, HEIGHT/10, align='center')
 
-        self.screen = self.view.screen
-        pg.display.flip()
+        if self.profiler.enabled:
+            self.profiler.draw(self, self.view.screen)
+
+        self.view.screen.set_clip(None)
+        self.profiler.mark('draw.gui')
+
+    def draw_dirty(self):
+        # What is on screen now, to compare with the last frame
+        drawn = {}
+        for sprite in self.visible_sprites():
+            drawn[sprite] = (self.draw_rect(sprite), sprite.image)
+        for ui in self.gui:
+            rect = self.gui_rect(ui)
+            if rect:
+                drawn[ui] = (rect, ui.image)
+
+        state = (self.view, self.camera.camera.topleft, self.paused, self.draw_debug, self.noclip)
+        if state != self.last_state or self.draw_debug or self.profiler.enabled:
+            # Scrolling or an overlay change touches the whole screen
+            self.draw_scene()
+            pg.display.flip()
+            self.profiler.mark('flip')
+            self.draw_stats['dirty'] = None
+
+        else:
+            rects = []
+            for key, (rect, image) in drawn.items():
+                last = self.last_drawn.get(key)
+                if last is None or last[0] != rect or last[1] is not image:
+                    rects.append(rect)
+                    if last is not None:
+                        rects.append(last[0])
+            for key, (rect, image) in self.last_drawn.items():
+                if key not in drawn:
+                    rects.append(rect)
+            rects += self.view.map.animated_rects(self.camera, self.view.screen.get_size())
+
+            rects = [rect.clip(self.view.screen.get_rect()) for rect in rects]
+            rects = [rect for rect in rects if rect.width and rect.height]
+            if len(rects) > DIRTY_RECTS_MAX:
+                rects = [rects[0].unionall(rects[1:])]
+
+            for rect in rects:
+                self.draw_scene(rect)
+            if rects:
+                pg.display.update(rects)
+            self.profiler.mark('flip')
+            self.draw_stats['dirty'] = len(rects)
+
+        self.last_drawn = drawn
+        self.last_state = state
 
     def events(self):
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 self.quit()
             if event.type == pg.KEYDOWN:
-                if event.key == pg.K_ESCAPE:
-                    self.quit()
-                if event.key == pg.K_h:
-                    self.draw_debug = not self.draw_debug
-                if event.key == pg.K_n:
-                    self.noclip = not self.noclip
-                if event.key == pg.K_p:
-                    self.paused = not self.paused
-                if event.key == pg.K_i:
-                    print(self.player.inventory)
-                if event.key == pg.K_v:
-                    self.player.hurt()
-                if event.key == pg.K_RETURN:
-                    self.player.use_closest_object()
+                self.key_down(event.key)
+
+    def key_down(self, key):
+        if self.recorder:
+            self.recorder.press(key)
+        if key == pg.K_ESCAPE:
+            self.quit()
+        if key == pg.K_h:
+            self.draw_debug = not self.draw_debug
+        if key == pg.K_j:
+            self.profiler.toggle()
+        if key == pg.K_k and self.profiler.enabled:
+            self.profiler.export_csv('profile.csv')
+            self.profiler.export_chrome_trace('profile.json')
+            print("Profile written to profile.csv and profile.json")
+        if key == pg.K_n:
+            self.noclip = not self.noclip
+        if key == pg.K_p:
+            self.paused = not self.paused
+        if key == pg.K_i:
+            print(self.player.inventory)
+        if key == pg.K_v:
+            self.player.hurt()
+        if key == pg.K_RETURN:
+            self.player.use_closest_object()
+        if key == pg.K_F5:
+            self.save(full=True)
 
     def show_start_screen(self):
         pass
@@ -374,10 +865,20 @@ class Game:
                 if event.type == pg.KEYUP:
                     waiting = False
 
-g = Game()
-g.show_start_screen()
-
-while True:
-    g.new()
-    g.run()
-    g.show_go_screen()
\ No newline at end of file
+if __name__ == '__main__':
+    g = Game(render_mode='dirty' if '--dirty' in sys.argv else RENDER_MODE)
+    g.show_start_screen()
+
+    recording = '--record' in sys.argv
+    if recording or '--new' in sys.argv or not g.load_game():
+        g.new()
+    if recording:
+        # Only the first game is recorded, replays start from a new one
+        g.recorder = Recorder(g, REPLAY_FILE)
+    while True:
+        g.run()
+        if g.recorder:
+            g.recorder.save()
+            g.recorder = None
+        g.show_go_screen()
+        g.new()
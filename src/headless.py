@@ -0,0 +1,136 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# headless.py                                       #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+# Runs the game loop without a window, as fast as possible,
+# with a fixed dt and scripted input.
+# Usage: python headless.py [frames] [--dt seconds] [--draw] [--record file]
+#        python headless.py --replay file
+
+try:
+    # System
+    import os
+    import sys
+    import time
+    # Game related
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import pygame as pg
+    from settings import *
+    from game import Game
+    from replay import KeyState, Recorder, Recording, replay
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+# Each step holds some keys for a number of frames and
+# presses the others (as KEYDOWN events) on its first frame
+DEFAULT_SCRIPT = [
+    (60, (pg.K_RIGHT,), ()),
+    (60, (pg.K_DOWN,), ()),
+    (60, (pg.K_LEFT,), ()),
+    (60, (pg.K_UP,), (pg.K_RETURN,)),
+    (30, (), ()),
+]
+
+class ScriptedInput:
+    def __init__(self, script=DEFAULT_SCRIPT, loop=True):
+        self.script = script
+        self.loop = loop
+        self.step = 0
+        self.frame = 0
+        self.keys = KeyState()
+
+    def next_frame(self):
+        # Returns the keys pressed this frame, updates the held ones
+        if self.step >= len(self.script):
+            if not self.loop:
+                self.keys = KeyState()
+                return ()
+            self.step = 0
+
+        frames, held, pressed = self.script[self.step]
+        self.keys = KeyState(held)
+        if self.frame > 0:
+            pressed = ()
+
+        self.frame += 1
+        if self.frame >= frames:
+            self.frame = 0
+            self.step += 1
+        return pressed
+
+    def get_pressed(self):
+        return self.keys
+
+def run_headless(frames, dt=1 / FPS, script=DEFAULT_SCRIPT, draw=False, game=None, record=None):
+    if game is None:
+        game = Game()
+        game.new()
+    if record:
+        game.recorder = Recorder(game, record)
+
+    source = ScriptedInput(script)
+    game.input = source.get_pressed
+    game.dt = dt
+    game.autosaving = False
+
+    start = time.perf_counter()
+    for frame in range(frames):
+        game.profiler.begin()
+        for key in source.next_frame():
+            game.key_down(key)
+        pg.event.pump()
+        game.profiler.mark('events')
+        if not game.paused:
+            game.update()
+        if draw:
+            game.draw()
+        game.profiler.end()
+    seconds = time.perf_counter() - start
+    if record:
+        game.recorder.save()
+        game.recorder = None
+
+    return {
+        'ticks': frames,
+        'seconds': seconds,
+        'tps': frames / seconds if seconds else 0,
+        'map': game.current_map,
+        'player': (game.player.pos.x, game.player.pos.y)
+    }
+
+if __name__ == '__main__':
+    frames = 10000
+    dt = 1 / FPS
+    args = sys.argv[1:]
+    if '--replay' in args:
+        result = replay(Game(), Recording.load(args[args.index('--replay') + 1]))
+        print("{ticks} ticks in {seconds:.2f}s, {tps:.0f} ticks/s".format(**result))
+        if result['diverged'] is None:
+            print("No divergence over {checked} checksums".format(**result))
+        else:
+            print("State diverged at tick {diverged}".format(**result))
+            sys.exit(1)
+        sys.exit(0)
+    record = None
+    if '--record' in args:
+        record = args[args.index('--record') + 1]
+        del args[args.index('--record'):args.index('--record') + 2]
+    if '--dt' in args:
+        dt = float(args[args.index('--dt') + 1])
+        del args[args.index('--dt'):args.index('--dt') + 2]
+    draw = '--draw' in args
+    args = [arg for arg in args if arg != '--draw']
+    if args:
+        frames = int(args[0])
+
+    result = run_headless(frames, dt, draw=draw, record=record)
+    print("{ticks} ticks in {seconds:.2f}s, {tps:.0f} ticks/s".format(**result))
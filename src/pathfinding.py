@@ -0,0 +1,141 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# pathfinding.py                                    #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import sys
+    # Game related
+    import numpy as np
+    from settings import *
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+# Neighbours a mob can step to, diagonals last
+STEPS = ((0, -1), (1, 0), (0, 1), (-1, 0), (1, -1), (1, 1), (-1, 1), (-1, -1))
+
+class FlowField:
+    # One breadth-first search from the player's tile shared by every mob:
+    # each tile stores the direction of its neighbour closest to the player.
+    # It is only recomputed when the player changes tile or a door opens.
+    def __init__(self, tiles_x, tiles_y, collision, entities, radius=FLOW_FIELD_RADIUS):
+        self.cols = tiles_x
+        self.rows = tiles_y
+        self.radius = radius
+
+        # A tile is a wall as soon as a wall touches it, the collision
+        # grid has one cell per tile and may start left of or above the map
+        self.walls = np.zeros((self.rows, self.cols), dtype=bool)
+        sx = -collision.origin[0] // TILE_SIZE
+        sy = -collision.origin[1] // TILE_SIZE
+        tiles = collision.solid[sy:sy + self.rows, sx:sx + self.cols]
+        self.walls[:tiles.shape[0], :tiles.shape[1]] = tiles
+
+        # Chests and closed doors, only doors ever open
+        self.doors = np.zeros((self.rows, self.cols), dtype=bool)
+        for entity in entities:
+            if not entity.open:
+                self.block(self.doors, entity.rect)
+
+        self.dist = np.full((self.rows, self.cols), np.inf)
+        self.steps = [[-2] * self.cols for y in range(self.rows)]
+        self.target = None
+        self.dirty = True
+        self.builds = 0
+
+    def tiles_under(self, rect):
+        x0 = max(0, rect.left // TILE_SIZE)
+        y0 = max(0, rect.top // TILE_SIZE)
+        x1 = min(self.cols, (rect.right - 1) // TILE_SIZE + 1)
+        y1 = min(self.rows, (rect.bottom - 1) // TILE_SIZE + 1)
+        return x0, y0, x1, y1
+
+    def block(self, grid, rect, value=True):
+        x0, y0, x1, y1 = self.tiles_under(rect)
+        grid[y0:y1, x0:x1] = value
+
+    def open_door(self, door):
+        self.block(self.doors, door.rect, False)
+        self.dirty = True
+
+    def tile_of(self, pos):
+        x = int(pos[0] // TILE_SIZE)
+        y = int(pos[1] // TILE_SIZE)
+        if 0 <= x < self.cols and 0 <= y < self.rows:
+            return x, y
+        return None
+
+    def update(self, target_pos):
+        tile = self.tile_of(target_pos)
+        if tile is None:
+            return
+        if tile != self.target or self.dirty:
+            self.target = tile
+            self.build()
+
+    def build(self):
+        self.dirty = False
+        self.builds += 1
+        passable = ~(self.walls | self.doors)
+
+        # Breadth-first search, the whole wavefront at once
+        dist = np.full((self.rows, self.cols), np.inf)
+        tx, ty = self.target
+        frontier = np.zeros((self.rows, self.cols), dtype=bool)
+        frontier[ty, tx] = True
+        dist[ty, tx] = 0
+        for step in range(1, self.radius + 1):
+            grow = np.zeros_like(frontier)
+            grow[1:, :] |= frontier[:-1, :]
+            grow[:-1, :] |= frontier[1:, :]
+            grow[:, 1:] |= frontier[:, :-1]
+            grow[:, :-1] |= frontier[:, 1:]
+            grow &= passable & np.isinf(dist)
+            if not grow.any():
+                break
+            dist[grow] = step
+            frontier = grow
+        self.dist = dist
+
+        # Each tile points to its closest neighbour, diagonals only
+        # when both tiles they cut through are free
+        padded = np.pad(dist, 1, constant_values=np.inf)
+        neighbours = []
+        for dx, dy in STEPS:
+            near = padded[1 + dy:1 + dy + self.rows, 1 + dx:1 + dx + self.cols].copy()
+            if dx and dy:
+                side_x = padded[1:1 + self.rows, 1 + dx:1 + dx + self.cols]
+                side_y = padded[1 + dy:1 + dy + self.rows, 1:1 + self.cols]
+                near[np.isinf(side_x) | np.isinf(side_y)] = np.inf
+            neighbours.append(near)
+        neighbours = np.stack(neighbours)
+
+        best = np.argmin(neighbours, axis=0)
+        improves = np.take_along_axis(neighbours, best[None], axis=0)[0] < dist
+        steps = np.where(improves, best, -1)
+        steps[np.isinf(dist)] = -2
+        # Mobs read single tiles, faster from lists than from an array
+        self.steps = steps.tolist()
+
+    def next_tile(self, pos):
+        # Tile to walk to from pos, the current tile once at the target
+        # and None when the target is out of reach
+        x = int(pos[0] // TILE_SIZE)
+        y = int(pos[1] // TILE_SIZE)
+        if not (0 <= x < self.cols and 0 <= y < self.rows):
+            return None
+        step = self.steps[y][x]
+        if step == -2:
+            return None
+        if step == -1:
+            return x, y
+        dx, dy = STEPS[step]
+        return x + dx, y + dy
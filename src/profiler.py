@@ -0,0 +1,150 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# profiler.py                                       #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import sys
+    import json
+    from time import perf_counter
+    # Game related
+    import numpy as np
+    import pygame as pg
+    from settings import *
+    from fonts import font_cache
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+PHASES = (
+    'events',
+    'update.sprites',
+    'update.collisions',
+    'update.triggers',
+    'draw.map',
+    'draw.sprites',
+    'draw.gui',
+    'flip'
+)
+
+class FrameProfiler:
+    # Per-phase frame timings in a ring buffer.
+    # mark(phase) charges the time since the previous mark to phase,
+    # so a phase entered several times in a frame adds up.
+    def __init__(self, size=PROFILER_FRAMES):
+        self.enabled = False
+        self.phases = {phase: i for i, phase in enumerate(PHASES)}
+        self.times = np.zeros((size, len(PHASES)))
+        self.starts = np.zeros(size)
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+        self.row = np.zeros(len(PHASES))
+        self.start = 0
+        self.last = 0
+
+        self.summary = {}
+        self.summary_age = 0
+        self.overlay = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.count = 0
+        self.index = 0
+        self.summary = {}
+        self.overlay = None
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.row[:] = 0
+        self.start = self.last = perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = perf_counter()
+        self.row[self.phases[phase]] += now - self.last
+        self.last = now
+
+    def end(self):
+        if not self.enabled:
+            return
+        self.times[self.index] = self.row
+        self.starts[self.index] = self.start
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.summary_age += 1
+
+    def frames(self):
+        # Recorded rows, oldest first
+        if self.count < self.size:
+            return self.starts[:self.count], self.times[:self.count]
+        order = np.r_[self.index:self.size, 0:self.index]
+        return self.starts[order], self.times[order]
+
+    def percentiles(self):
+        # p50, p95 and p99 in milliseconds for each phase and the whole frame
+        starts, times = self.frames()
+        if not len(times):
+            return {}
+        columns = dict(zip(PHASES, times.T))
+        columns['frame'] = times.sum(axis=1)
+        return {name: tuple(float(t) for t in np.percentile(column, (50, 95, 99)) * 1000)
+                for name, column in columns.items()}
+
+    def draw(self, game, surface):
+        # The overlay is only rebuilt a few times per second
+        if self.summary_age >= PROFILER_REFRESH or self.overlay is None:
+            self.summary = self.percentiles()
+            self.summary_age = 0
+            self.overlay = self.make_overlay(game) if self.summary else None
+        if self.overlay:
+            surface.blit(self.overlay, (WIDTH - self.overlay.get_width() - 10, 10))
+
+    def make_overlay(self, game):
+        rows = [('ms', 'p50', 'p95', 'p99')]
+        for name in PHASES + ('frame',):
+            rows.append((name,) + tuple("{:.2f}".format(t) for t in self.summary[name]))
+
+        # The numbers change on every refresh, rendered without the text
+        # cache so they don't push out the texts worth keeping
+        font = font_cache.font(game.second_font, 20)
+        box = pg.Surface((320, 18 * len(rows) + 10), pg.SRCALPHA)
+        box.fill((0, 0, 0, 188))
+        for i, row in enumerate(rows):
+            y = 5 + i * 18
+            box.blit(font.render(row[0], True, WHITE), (8, y))
+            for j, value in enumerate(row[1:]):
+                text = font.render(value, True, WHITE)
+                box.blit(text, text.get_rect(topright=(200 + j * 55, y)))
+        return box
+
+    def export_csv(self, filename):
+        starts, times = self.frames()
+        with open(filename, 'w') as f:
+            f.write(','.join(('frame',) + PHASES) + '\n')
+            for i, row in enumerate(times):
+                f.write(','.join([str(i)] + ["{:.4f}".format(t * 1000) for t in row]) + '\n')
+
+    def export_chrome_trace(self, filename):
+        # Phases are laid out back to back inside each frame
+        events = []
+        starts, times = self.frames()
+        for start, row in zip(starts, times):
+            ts = start * 1e6
+            for phase, duration in zip(PHASES, row):
+                if duration > 0:
+                    events.append({'name': phase, 'cat': phase.split('.')[0], 'ph': 'X',
+                                   'ts': ts, 'dur': duration * 1e6, 'pid': 1, 'tid': 1})
+                    ts += duration * 1e6
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
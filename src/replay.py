@@ -0,0 +1,179 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# replay.py                                         #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import sys
+    import time
+    import struct
+    import hashlib
+    # Game related
+    import pygame as pg
+    from settings import *
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+# Recordings
+# The input of every update as runs of identical ticks: the keys held,
+# the keys pressed just before the first tick of the run and dt. A run
+# of no tick only carries presses, for a key pressed twice in a tick.
+REPLAY_MAGIC = b'RREC'
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct('<4sHHII')    # magic, version, hash interval, runs, checksums
+REPLAY_RUN = struct.Struct('<HHHd')         # ticks, held, pressed, dt
+REPLAY_CHECKSUM = struct.Struct('<I8s')     # tick, state hash
+LENGTH = struct.Struct('<H')
+MAX_RUN = 0xffff
+
+# One bit per key, in this order
+HELD_KEYS = (pg.K_LEFT, pg.K_RIGHT, pg.K_UP, pg.K_DOWN, pg.K_q, pg.K_d, pg.K_z, pg.K_s)
+PRESSED_KEYS = (pg.K_RETURN, pg.K_h, pg.K_j, pg.K_n, pg.K_p, pg.K_v, pg.K_i)
+
+def mask_of(keys, order):
+    mask = 0
+    for bit, key in enumerate(order):
+        if keys[key]:
+            mask |= 1 << bit
+    return mask
+
+def keys_of(mask, order):
+    return [key for bit, key in enumerate(order) if mask & 1 << bit]
+
+def state_hash(game):
+    # The player's position, the flags of the current view and its map
+    state = hashlib.blake2b(digest_size=8)
+    state.update(game.current_map.encode('utf-8'))
+    state.update(struct.pack('<dd', game.player.pos.x, game.player.pos.y))
+    state.update(game.view.store.flags.tobytes())
+    return state.digest()
+
+class Recording:
+    def __init__(self, map_name, interval=REPLAY_HASH_INTERVAL):
+        self.map_name = map_name
+        self.interval = interval
+        self.runs = []          # [ticks, held, pressed, dt]
+        self.checksums = []     # (tick, hash)
+
+    def ticks(self):
+        return sum(run[0] for run in self.runs)
+
+    def save(self, filename):
+        out = bytearray(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.interval,
+                                           len(self.runs), len(self.checksums)))
+        name = self.map_name.encode('utf-8')
+        out += LENGTH.pack(len(name))
+        out += name
+        for run in self.runs:
+            out += REPLAY_RUN.pack(*run)
+        for tick, digest in self.checksums:
+            out += REPLAY_CHECKSUM.pack(tick, digest)
+        with open(filename, 'wb') as f:
+            f.write(out)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        magic, version, interval, run_count, checksum_count = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("not a recording of this version")
+        offset = REPLAY_HEADER.size
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        recording = Recording(data[offset:offset + length].decode('utf-8'), interval)
+        offset += length
+
+        recording.runs = [list(run) for run in REPLAY_RUN.iter_unpack(data[offset:offset + run_count * REPLAY_RUN.size])]
+        offset += run_count * REPLAY_RUN.size
+        recording.checksums = list(REPLAY_CHECKSUM.iter_unpack(data[offset:offset + checksum_count * REPLAY_CHECKSUM.size]))
+        return recording
+
+class Recorder:
+    # Records what the simulation reads from the player, from the start
+    # of a new game. The game calls press() for each key it handles and
+    # tick() at the start of each update.
+    def __init__(self, game, filename, interval=REPLAY_HASH_INTERVAL):
+        self.game = game
+        self.filename = filename
+        self.recording = Recording(game.current_map, interval)
+        self.tick_count = 0
+        self.pressed = 0
+
+    def press(self, key):
+        if key not in PRESSED_KEYS:
+            return
+        bit = 1 << PRESSED_KEYS.index(key)
+        if self.pressed & bit:
+            # Pressed again before a tick, flush the first press
+            self.recording.runs.append([0, 0, self.pressed, self.game.dt])
+            self.pressed = 0
+        self.pressed |= bit
+
+    def tick(self):
+        recording = self.recording
+        if self.tick_count % recording.interval == 0:
+            recording.checksums.append((self.tick_count, state_hash(self.game)))
+
+        held = mask_of(self.game.input(), HELD_KEYS)
+        dt = self.game.dt
+        last = recording.runs[-1] if recording.runs else None
+        if (last and last[0] and last[0] < MAX_RUN and not self.pressed
+                and last[1] == held and last[3] == dt):
+            last[0] += 1
+        else:
+            recording.runs.append([1, held, self.pressed, dt])
+            self.pressed = 0
+        self.tick_count += 1
+
+    def save(self):
+        self.recording.save(self.filename)
+
+class KeyState:
+    # Quacks like pg.key.get_pressed()
+    def __init__(self, held=()):
+        self.held = set(held)
+
+    def __getitem__(self, key):
+        return key in self.held
+
+def replay(game, recording):
+    # Feeds a recording to a new game through Game.update and checks the
+    # state hashes on the way, diverged is the first tick that differs
+    game.new(recording.map_name)
+    game.autosaving = False
+    game.recorder = None
+    keys = KeyState()
+    game.input = lambda: keys
+    checksums = dict(recording.checksums)
+
+    tick = 0
+    diverged = None
+    start = time.perf_counter()
+    for ticks, held, pressed, dt in recording.runs:
+        for key in keys_of(pressed, PRESSED_KEYS):
+            game.key_down(key)
+        keys.held = set(keys_of(held, HELD_KEYS))
+        game.dt = dt
+        for i in range(ticks):
+            if diverged is None and tick in checksums and state_hash(game) != checksums[tick]:
+                diverged = tick
+            game.update()
+            tick += 1
+    seconds = time.perf_counter() - start
+
+    return {
+        'ticks': tick,
+        'seconds': seconds,
+        'tps': tick / seconds if seconds else 0,
+        'checked': len(checksums),
+        'diverged': diverged
+    }
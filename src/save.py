@@ -0,0 +1,266 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# save.py                                           #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import os
+    import sys
+    import queue
+    import struct
+    import threading
+    from os import path
+    # Game related
+    import numpy as np
+    from settings import *
+    from store import ViewState, ENTITY, TRIGGER, ITEM, MOB
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+# Save files
+# A full save holds the state of every map, the delta save only the
+# objects that changed since the full save it names as its base.
+SAVE_MAGIC = b'RSAV'
+SAVE_VERSION = 1
+FULL, DELTA = 0, 1
+SAVE_HEADER = struct.Struct('<4sHBII')      # magic, version, type, sequence, base sequence
+SAVE_PLAYER = struct.Struct('<ddh')         # x, y, health
+SAVE_RECORD = struct.Struct('<iBBBdd')      # id, kind, flags, alive, x, y
+COUNT = struct.Struct('<I')
+LENGTH = struct.Struct('<H')
+
+# Kinds of objects whose state is saved
+DYNAMIC = (ENTITY, TRIGGER, ITEM, MOB)
+
+def records(state):
+    # A view's state as {(id, kind): (flags, alive, x, y, inventory)}
+    positions = {int(id): (x, y) for id, x, y in state.mobs.tolist()}
+    removed = set(state.removed.tolist())
+    out = {}
+    for id, kind, flags in zip(state.ids.tolist(), state.kinds.tolist(), state.flags.tolist()):
+        if kind not in DYNAMIC:
+            continue
+        x, y = positions.get(id, (0, 0)) if kind == MOB else (0, 0)
+        inventory = tuple(state.inventories.get(id, ())) if kind == ENTITY else ()
+        out[(id, kind)] = (flags, int(id not in removed), x, y, inventory)
+    return out
+
+def state_of(records):
+    # Back to a ViewState, for ViewCache.restore
+    keys = list(records)
+    values = [records[key] for key in keys]
+    inventories = {id: list(value[4]) for (id, kind), value in zip(keys, values) if kind == ENTITY}
+    mobs = [(id, value[2], value[3]) for (id, kind), value in zip(keys, values) if kind == MOB]
+    removed = [id for (id, kind), value in zip(keys, values) if kind == ITEM and not value[1]]
+    return ViewState(np.array([id for id, kind in keys], dtype=np.int32),
+                     np.array([kind for id, kind in keys], dtype=np.uint8),
+                     np.array([value[0] for value in values], dtype=np.uint8),
+                     inventories, np.array(mobs).reshape(-1, 3), np.array(removed, dtype=np.int32), None)
+
+def pack_string(out, text):
+    data = text.encode('utf-8')
+    out += LENGTH.pack(len(data))
+    out += data
+
+def pack_strings(out, texts):
+    out += LENGTH.pack(len(texts))
+    for text in texts:
+        pack_string(out, text)
+
+def pack(type, sequence, base, player, maps):
+    map_name, x, y, health, inventory = player
+    out = bytearray(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, type, sequence, base))
+    pack_string(out, map_name)
+    out += SAVE_PLAYER.pack(x, y, health)
+    pack_strings(out, inventory)
+
+    out += COUNT.pack(len(maps))
+    for name, map_records in maps.items():
+        pack_string(out, name)
+        out += COUNT.pack(len(map_records))
+        for (id, kind), (flags, alive, x, y, inventory) in map_records.items():
+            out += SAVE_RECORD.pack(id, kind, flags, alive, x, y)
+            pack_strings(out, inventory)
+    return bytes(out)
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, format):
+        values = format.unpack_from(self.data, self.offset)
+        self.offset += format.size
+        return values
+
+    def string(self):
+        length, = self.read(LENGTH)
+        text = self.data[self.offset:self.offset + length].decode('utf-8')
+        self.offset += length
+        return text
+
+    def strings(self):
+        count, = self.read(LENGTH)
+        return [self.string() for i in range(count)]
+
+def unpack(data):
+    reader = Reader(data)
+    magic, version, type, sequence, base = reader.read(SAVE_HEADER)
+    if magic != SAVE_MAGIC or version != SAVE_VERSION:
+        raise ValueError("not a save file of this version")
+
+    map_name = reader.string()
+    x, y, health = reader.read(SAVE_PLAYER)
+    player = (map_name, x, y, health, reader.strings())
+
+    maps = {}
+    map_count, = reader.read(COUNT)
+    for i in range(map_count):
+        name = reader.string()
+        map_records = {}
+        count, = reader.read(COUNT)
+        for j in range(count):
+            id, kind, flags, alive, x, y = reader.read(SAVE_RECORD)
+            map_records[(id, kind)] = (flags, alive, x, y, tuple(reader.strings()))
+        maps[name] = map_records
+    return type, sequence, base, player, maps
+
+def write_file(filename, data):
+    # Never leaves a half written save behind
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, filename)
+
+def read_save(folder):
+    # The player and {map: records} of the full save with its delta
+    # applied, None when there is no save
+    full = path.join(folder, SAVE_FULL)
+    if not path.exists(full):
+        return None
+    with open(full, 'rb') as f:
+        type, sequence, base, player, maps = unpack(f.read())
+
+    delta = path.join(folder, SAVE_DELTA)
+    if path.exists(delta):
+        with open(delta, 'rb') as f:
+            delta_type, delta_sequence, delta_base, delta_player, delta_maps = unpack(f.read())
+        # A delta against an older full save is stale
+        if delta_base == sequence and delta_sequence > sequence:
+            player = delta_player
+            for name, map_records in delta_maps.items():
+                maps.setdefault(name, {}).update(map_records)
+    return player, maps
+
+def saved_map(folder):
+    # The map the player was saved on, from the headers and player sections
+    # only, None when there is no readable save
+    found = {}
+    for name in (SAVE_FULL, SAVE_DELTA):
+        try:
+            with open(path.join(folder, name), 'rb') as f:
+                reader = Reader(f.read(SAVE_HEADER.size + LENGTH.size + 0xffff))
+            magic, version, type, sequence, base = reader.read(SAVE_HEADER)
+            if magic == SAVE_MAGIC and version == SAVE_VERSION:
+                found[name] = (sequence, base, reader.string())
+        except (OSError, ValueError, struct.error):
+            pass
+    if SAVE_FULL not in found:
+        return None
+    sequence, base, map_name = found[SAVE_FULL]
+    if SAVE_DELTA in found:
+        delta_sequence, delta_base, delta_map = found[SAVE_DELTA]
+        # Same rule as read_save
+        if delta_base == sequence and delta_sequence > sequence:
+            map_name = delta_map
+    return map_name
+
+def last_sequence(folder):
+    sequence = 0
+    for name in (SAVE_FULL, SAVE_DELTA):
+        try:
+            with open(path.join(folder, name), 'rb') as f:
+                magic, version, type, file_sequence, base = SAVE_HEADER.unpack(f.read(SAVE_HEADER.size))
+            sequence = max(sequence, file_sequence)
+        except (OSError, struct.error):
+            pass
+    return sequence
+
+class SaveWriter:
+    # Serializes and writes saves on its own thread. The game hands
+    # it snapshots it already took and never waits: when a save is
+    # still being written the new one is skipped.
+    def __init__(self, folder):
+        self.folder = folder
+        self.jobs = queue.Queue(maxsize=1)
+        # Carry on numbering after the saves already there,
+        # so an old delta can never pass for one of a new full save
+        self.sequence = last_sequence(folder)
+        self.base = None
+        self.base_sequence = 0
+        self.written = 0
+        self.skipped = 0
+        self.last_size = 0
+
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def request(self, player, states, full=False):
+        try:
+            self.jobs.put_nowait((player, states, full))
+            return True
+        except queue.Full:
+            self.skipped += 1
+            return False
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self.write(*job)
+            except Exception as err:
+                print("Couldn't save: {}".format(err))
+            finally:
+                self.jobs.task_done()
+
+    def write(self, player, states, full):
+        os.makedirs(self.folder, exist_ok=True)
+        maps = {name: records(state) for name, state in states.items()}
+        self.sequence += 1
+
+        if not full and self.base is not None:
+            delta = {}
+            for name, map_records in maps.items():
+                base = self.base.get(name, {})
+                changed = {key: value for key, value in map_records.items() if base.get(key) != value}
+                if changed:
+                    delta[name] = changed
+            # Past some size a new full save is worth it
+            changes = sum(len(changed) for changed in delta.values())
+            total = sum(len(map_records) for map_records in self.base.values())
+            if changes <= total * SAVE_DELTA_RATIO:
+                data = pack(DELTA, self.sequence, self.base_sequence, player, delta)
+                write_file(path.join(self.folder, SAVE_DELTA), data)
+                self.last_size = len(data)
+                self.written += 1
+                return
+
+        data = pack(FULL, self.sequence, self.sequence, player, maps)
+        write_file(path.join(self.folder, SAVE_FULL), data)
+        self.base = maps
+        self.base_sequence = self.sequence
+        self.last_size = len(data)
+        self.written += 1
+
+    def wait(self):
+        self.jobs.join()
@@ -27,6 +27,55 @@ TITLE = "Rise Of The Sorceler"
 FPS = 60
 TILE_SIZE = 64
 
+# The simulation runs at a fixed rate whatever the frame rate (FPS = 0
+# renders uncapped), a slow frame is caught up with MAX_SIM_STEPS at most
+SIM_RATE = 60
+MAX_SIM_STEPS = 5
+
+# 'full' redraws and flips the whole screen every frame,
+# 'dirty' only updates the regions that changed since the last one
+RENDER_MODE = 'full'
+# Past this many dirty regions they are merged into one
+DIRTY_RECTS_MAX = 16
+
+# Frames kept by the frame profiler, and how often its overlay is refreshed
+PROFILER_FRAMES = 600
+PROFILER_REFRESH = 15
+
+# Map chunks are baked lazily, CHUNK_SIZE tiles per side,
+# and at most CHUNK_CACHE_SIZE of them are kept in memory
+CHUNK_SIZE = 8
+CHUNK_CACHE_SIZE = 64
+
+# Byte budget for the maps kept loaded by the MapRegistry
+MAP_CACHE_BUDGET = 96 * 1024 * 1024
+# Bytes of visited views kept whole, older ones only keep their state
+VIEW_CACHE_BUDGET = 128 * 1024 * 1024
+
+# A prefetched view is built over several frames, for this many
+# seconds of each, checking the time every VIEW_BUILD_BATCH map objects
+PREFETCH_SLICE = 0.004
+VIEW_BUILD_BATCH = 64
+
+# Threads decoding and parsing assets while the game loads
+ASSET_WORKERS = 4
+
+# Saves
+SAVE_FOLDER = 'saves'
+SAVE_FULL = 'save.dat'
+SAVE_DELTA = 'save.delta'
+# Seconds of play between autosaves
+AUTOSAVE_INTERVAL = 30
+# A delta changing more than this share of the objects makes a full save
+SAVE_DELTA_RATIO = 0.5
+
+# Input recordings store a state hash every this many ticks
+REPLAY_HASH_INTERVAL = 60
+REPLAY_FILE = 'replay.rec'
+
+# Cell size of the spatial hash indexing the sprites of a view
+SPATIAL_CELL_SIZE = TILE_SIZE * 2
+
 SPRITESHEET = 'charset.png'
 
 BOB_RANGE = 15
@@ -49,6 +98,12 @@ PLAYER_INTERACT_RANGE = 120
 HEART_SPRITE = 749
 
 # Mobs
+MOB_SPEED = 150
+MOB_HIT_RECT = pg.Rect(0, 0, 35, 45)
+# Mobs stop this close to the player
+MOB_STOP_RANGE = 40
+# Mobs further than this many tiles from the player stay still
+FLOW_FIELD_RADIUS = 24
 MOBS_SPRITES = {
     'guard': 29
 }
@@ -137,6 +192,10 @@ ITEMS_LAYER = 1
 MAIN_FONT = 'unipix.ttf'
 SECOND_FONT = 'kenney_pixel.ttf'
 
+# Loaded fonts and rendered texts kept in memory
+FONT_CACHE_SIZE = 16
+TEXT_CACHE_SIZE = 128
+
 # Other stuff
 DIALOG_LIFETIME = 2500
 
@@ -0,0 +1,202 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+# store.py                                          #
+#                                                   #
+# Rise of the Sorceler                              #
+# A simple 2d rogue-like game                       #
+#                                                   #
+# Released under the GNU General Public License     #
+# Made by An0rak                                    #
+# # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+try:
+    # System
+    import sys
+    from collections import namedtuple
+    # Game related
+    import numpy as np
+    import pygame as pg
+    from settings import *
+
+except ImportError as err:
+    print("Couldn't load module. {err}")
+    sys.exit(2)
+
+# Kinds of map objects
+KINDS = ('wall', 'trigger', 'passage', 'entity', 'item', 'mob')
+WALL, TRIGGER, PASSAGE, ENTITY, ITEM, MOB = range(len(KINDS))
+
+# State flags
+USED = 1        # Door opened or chest emptied
+CALLED = 2      # Event trigger already fired
+
+# The dynamic state of a view's objects, keyed by Tiled id: the ids,
+# kinds and flags of its rows, chest inventories, mobs as (id, x, y),
+# the ids of removed items and the bobbing phase as (ids, step, dir,
+# centery) or None
+ViewState = namedtuple('ViewState', 'ids kinds flags inventories mobs removed bobbing')
+
+COLUMNS = (
+    ('id', np.int32),       # Tiled object id
+    ('kind', np.uint8),
+    ('name', np.int16),     # Index in names
+    ('x', np.int32),
+    ('y', np.int32),
+    ('w', np.int32),
+    ('h', np.int32),
+    ('sprite', np.int32),   # Spritesheet index, -1 when never drawn
+    ('flags', np.uint8)
+)
+
+class ObjectStore:
+    # Every object of a map as one row of struct-of-arrays tables.
+    # Rows are appended while the map loads, freeze() turns the
+    # columns into NumPy arrays and afterwards only state changes.
+    def __init__(self):
+        self.names = []
+        self.name_index = {}
+        self.columns = {column: [] for column, dtype in COLUMNS}
+        self.groups = []
+
+    def __len__(self):
+        return len(self.kind)
+
+    def add(self, kind, id, name, rect, sprite=-1):
+        if name not in self.name_index:
+            self.name_index[name] = len(self.names)
+            self.names.append(name)
+
+        columns = self.columns
+        columns['id'].append(id)
+        columns['kind'].append(kind)
+        columns['name'].append(self.name_index[name])
+        columns['x'].append(rect.x)
+        columns['y'].append(rect.y)
+        columns['w'].append(rect.width)
+        columns['h'].append(rect.height)
+        columns['sprite'].append(sprite)
+        columns['flags'].append(0)
+        return len(columns['id']) - 1
+
+    def freeze(self):
+        for column, dtype in COLUMNS:
+            setattr(self, column, np.array(self.columns[column], dtype=dtype))
+        self.columns = None
+        for group in self.groups:
+            group.build()
+
+    def group(self, kind, record):
+        group = StoreGroup(self, kind, record)
+        self.groups.append(group)
+        return group
+
+    def rect(self, row):
+        return pg.Rect(int(self.x[row]), int(self.y[row]), int(self.w[row]), int(self.h[row]))
+
+    def name_of(self, row):
+        return self.names[self.name[row]]
+
+    def flag(self, row, flag):
+        return bool(self.flags[row] & flag)
+
+    def set_flag(self, row, flag, value=True):
+        if value:
+            self.flags[row] |= flag
+        else:
+            self.flags[row] &= ~np.uint8(flag)
+
+class StoreGroup:
+    # The rows of one kind, standing in for the sprite group of objects
+    # that are never drawn. Iterating makes a light record per row.
+    def __init__(self, store, kind, record):
+        self.store = store
+        self.kind = kind
+        self.record = record
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.bounds = np.zeros((4, 0), dtype=np.int32)
+
+    def build(self):
+        store = self.store
+        self.rows = np.flatnonzero(store.kind == self.kind)
+        x = store.x[self.rows]
+        y = store.y[self.rows]
+        self.bounds = np.stack((x, y, x + store.w[self.rows], y + store.h[self.rows]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return (self.record(self.store, row) for row in self.rows.tolist())
+
+    def __contains__(self, record):
+        return getattr(record, 'store', None) is self.store and self.store.kind[record.row] == self.kind
+
+    def sprites(self):
+        return list(self)
+
+    def query_rect(self, rect):
+        # Records colliding with rect like Rect.colliderect, in load order
+        left, top, right, bottom = self.bounds
+        hits = ((left < rect.right) & (right > rect.left) & (top < rect.bottom) & (bottom > rect.top)
+                & (right > left) & (bottom > top))
+        return [self.record(self.store, row) for row in self.rows[hits].tolist()]
+
+class TriggerCells:
+    # The triggers touching each tile, so only the few under the player
+    # are tested against its rect. The candidates only change when the
+    # rect crosses a tile boundary. update() reports the triggers entered
+    # and left, the ones stayed in are kept in inside.
+    def __init__(self, group):
+        self.group = group
+        self.cell = TILE_SIZE
+
+        self.cells = {}
+        self.bounds = {}
+        for row, left, top, right, bottom in zip(group.rows.tolist(), *group.bounds.tolist()):
+            if right <= left or bottom <= top:
+                continue
+            self.bounds[row] = (left, top, right, bottom)
+            for y in range(top // self.cell, (bottom - 1) // self.cell + 1):
+                for x in range(left // self.cell, (right - 1) // self.cell + 1):
+                    self.cells.setdefault((x, y), []).append(row)
+
+        self.span = None
+        self.candidates = []
+        self.inside = []
+
+    def span_of(self, rect):
+        return (rect.left // self.cell, rect.top // self.cell,
+                (rect.right - 1) // self.cell, (rect.bottom - 1) // self.cell)
+
+    def update(self, rect):
+        span = self.span_of(rect)
+        if span != self.span:
+            self.span = span
+            x0, y0, x1, y1 = span
+            rows = set()
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    rows.update(self.cells.get((x, y), ()))
+            self.candidates = sorted(rows)
+
+        # Exact test, like Rect.colliderect
+        inside = []
+        for row in self.candidates:
+            left, top, right, bottom = self.bounds[row]
+            if left < rect.right and right > rect.left and top < rect.bottom and bottom > rect.top:
+                inside.append(row)
+        if inside == self.inside:
+            return [], []
+
+        entered = [row for row in inside if row not in self.inside]
+        left = [row for row in self.inside if row not in inside]
+        self.inside = inside
+
+        record = self.group.record
+        store = self.group.store
+        return [record(store, row) for row in entered], [record(store, row) for row in left]
+
+    def reset(self, rect):
+        # Take the triggers under rect as already entered
+        self.span = None
+        self.inside = []
+        self.update(rect)
@@ -10,9 +10,22 @@
 
 try:
     # System
+    import os
     import sys
+    import mmap
+    import queue
+    import struct
+    import hashlib
+    import threading
+    from os import path
+    from bisect import bisect_right
+    from array import array
+    from collections import OrderedDict, namedtuple
+    import xml.etree.ElementTree as ET
     # Game related
     import pytmx
+    from pytmx.util_pygame import handle_transformation
+    import numpy as np
     import pygame as pg
     from settings import *
 
@@ -23,26 +36,912 @@ except ImportError as err:
 def collide_hit_rect(one, two):
     return one.hit_rect.colliderect(two.rect)
 
+class TileCache:
+    # Scaled tile images shared by every TiledMap, keyed by
+    # (tileset, local tile id, flip flags) so gids of different maps don't clash
+    def __init__(self):
+        self.tiles = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, image):
+        tile = self.tiles.get(key)
+        if tile is None:
+            self.misses += 1
+            tile = pg.transform.scale(image, (TILE_SIZE, TILE_SIZE)).convert_alpha()
+            self.tiles[key] = tile
+        else:
+            self.hits += 1
+        return tile
+
+    def clear(self):
+        self.tiles.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'size': len(self.tiles), 'hits': self.hits, 'misses': self.misses}
+
+tile_cache = TileCache()
+
+def decode_image_loader(filename, colorkey, **kwargs):
+    # pytmx image loader that only decodes, for loading off the main
+    # thread. The tile cache converts the tiles when it scales them.
+    image = pg.image.load(filename)
+
+    def load_image(rect=None, flags=None):
+        tile = image.subsurface(rect) if rect else image.copy()
+        if flags:
+            tile = handle_transformation(tile, flags)
+        return tile
+
+    return load_image
+
+class TileAnimations:
+    # The animated cells of a map: every cell where some layer holds an
+    # animated tile, with its whole stack of layers so it can be drawn
+    # again over the baked chunks. Tiles are indices into the images,
+    # negative ones are animations (~index). The images are scaled
+    # once, on first use, by load_tiles.
+    def __init__(self, load_tiles, animations, cells, chunk_size):
+        self.load_tiles = load_tiles
+        self.tiles = None
+        self.animations = animations    # [(tile indices, durations in ms)]
+        self.cell_list = cells          # [(x, y, layers)] in tiles
+        self.ends = [np.cumsum(durations).tolist() for tiles, durations in animations]
+
+        # Cells by chunk, so only the ones in view are looked at
+        self.cells = {}
+        for x, y, layers in cells:
+            self.cells.setdefault((x // chunk_size, y // chunk_size), []).append((x, y, layers))
+
+        self.indices = [0] * len(animations)
+        self.frames = None
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.cell_list)
+
+    def get_size(self):
+        if self.tiles is None:
+            return 0
+        return sum(tile.get_width() * tile.get_height() * tile.get_bytesize() for tile in self.tiles)
+
+    def animate(self, now):
+        # Frames to show at now in ms, changed holds the animations
+        # whose frame is not the one shown last time
+        if self.tiles is None:
+            self.tiles = self.load_tiles()
+        self.changed = set()
+        frames = []
+        for i, ((tiles, durations), ends) in enumerate(zip(self.animations, self.ends)):
+            index = bisect_right(ends, now % ends[-1]) if ends[-1] else 0
+            if index != self.indices[i]:
+                self.indices[i] = index
+                self.changed.add(i)
+            frames.append(self.tiles[tiles[index]])
+        self.frames = frames
+
+    def visible(self, chunks, view):
+        for chunk in chunks:
+            for x, y, layers in self.cells.get(chunk, ()):
+                rect = pg.Rect(x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+                if rect.colliderect(view):
+                    yield rect, layers
+
+    def changed_rects(self, chunks, view):
+        # Cells in view showing another frame since the last animate
+        if not self.changed:
+            return []
+        return [rect for rect, layers in self.visible(chunks, view)
+                if any(layer < 0 and ~layer in self.changed for layer in layers)]
+
+    def draw(self, surface, camera, chunks, view):
+        if self.frames is None:
+            self.animate(0)
+        tiles = self.tiles
+        frames = self.frames
+        for rect, layers in self.visible(chunks, view):
+            rect = camera.apply_rect(rect)
+            surface.fill(BG_COLOR, rect)
+            for layer in layers:
+                surface.blit(tiles[layer] if layer >= 0 else frames[~layer], rect)
+
 class TiledMap:
-    def __init__(self, filename):
-        tm = pytmx.load_pygame(filename, pixelalpha=True)
-        self.width = tm.width * TILE_SIZE
-        self.height = tm.height * TILE_SIZE
+    def __init__(self, filename, chunk_size=CHUNK_SIZE, cache_size=CHUNK_CACHE_SIZE, convert=True):
+        if convert:
+            tm = pytmx.load_pygame(filename, pixelalpha=True)
+        else:
+            tm = pytmx.TiledMap(filename, image_loader=decode_image_loader, pixelalpha=True)
+        self.filename = filename
         self.tilesize = tm.tileheight
         self.tmxdata = tm
+        self.tile_keys = {}
+        self.setup_chunks(tm.width, tm.height, chunk_size, cache_size)
+        self.animations = self.find_animations()
+
+        # Rough bytes of the parsed tmx: layer grids, tile images and objects
+        layers = [layer for layer in tm.visible_layers if isinstance(layer, pytmx.TiledTileLayer)]
+        self.parsed_size = len(layers) * tm.width * tm.height * 8
+        self.parsed_size += sum(image.get_width() * image.get_height() * image.get_bytesize()
+                                for image in tm.images if image)
+        self.parsed_size += sum(1 for tile_object in tm.objects) * OBJECT_SIZE
+
+    def setup_chunks(self, tiles_x, tiles_y, chunk_size, cache_size):
+        self.tiles_x = tiles_x
+        self.tiles_y = tiles_y
+        self.width = tiles_x * TILE_SIZE
+        self.height = tiles_y * TILE_SIZE
+
+        self.chunk_size = chunk_size
+        self.chunk_px = chunk_size * TILE_SIZE
+        self.chunks_x = -(-tiles_x // chunk_size)
+        self.chunks_y = -(-tiles_y // chunk_size)
+        self.cache_size = cache_size
+        self.chunks = OrderedDict()
+
+    @property
+    def objects(self):
+        return self.tmxdata.objects
+
+    def tile_key(self, gid):
+        key = self.tile_keys.get(gid)
+        if key is None:
+            tiled_gid = self.tmxdata.tiledgidmap[gid]
+            flags = None
+            for pgid, tflags in self.tmxdata.gidmap[tiled_gid]:
+                if pgid == gid:
+                    flags = tuple(tflags)
+            tileset = self.tmxdata.get_tileset_from_gid(gid)
+            # The image the tile comes from, per tile for image collections,
+            # resolved so maps in different folders can't clash
+            source = tileset.source
+            if source is None:
+                properties = self.tmxdata.tile_properties.get(gid) or {}
+                source = properties.get('source')
+            if source is not None:
+                source = path.abspath(path.join(path.dirname(self.tmxdata.filename), source))
+            key = (source, tiled_gid - tileset.firstgid, flags)
+            self.tile_keys[gid] = key
+        return key
+
+    def tiled_gid(self, gid):
+        # The gid as written in the tmx, flip flags included
+        if not gid:
+            return 0
+        tiled_gid = self.tmxdata.tiledgidmap[gid]
+        for pgid, flags in self.tmxdata.gidmap[tiled_gid]:
+            if pgid == gid:
+                if flags.flipped_horizontally:
+                    tiled_gid |= GID_FLIP_X
+                if flags.flipped_vertically:
+                    tiled_gid |= GID_FLIP_Y
+                if flags.flipped_diagonally:
+                    tiled_gid |= GID_FLIP_DIAGONAL
+        return tiled_gid
+
+    def get_tile(self, gid):
+        image = self.tmxdata.get_tile_image_by_gid(gid)
+        if not image:
+            return None
+        return tile_cache.get(self.tile_key(gid), image)
+
+    def find_animations(self):
+        # None when no tile of the map is animated
+        tm = self.tmxdata
+        animated = {gid: props['frames'] for gid, props in tm.tile_properties.items() if props.get('frames')}
+        if not animated:
+            return None
+
+        layers = [np.array(layer.data, dtype=np.int64) for layer in tm.visible_layers
+                  if isinstance(layer, pytmx.TiledTileLayer)]
+        found = np.zeros((self.tiles_y, self.tiles_x), dtype=bool)
+        for layer in layers:
+            found[:layer.shape[0], :layer.shape[1]] |= np.isin(layer, list(animated))
+        if not found.any():
+            return None
+
+        gids = []
+        tile_index = {}
+        def tile(gid):
+            if gid not in tile_index:
+                tile_index[gid] = len(gids)
+                gids.append(gid)
+            return tile_index[gid]
+
+        animations = []
+        animation_index = {}
+        def animation(gid):
+            if gid not in animation_index:
+                animation_index[gid] = len(animations)
+                animations.append(([tile(frame.gid) for frame in animated[gid]],
+                                   [frame.duration for frame in animated[gid]]))
+            return ~animation_index[gid]
+
+        cells = []
+        for y, x in zip(*np.nonzero(found)):
+            stack = []
+            for layer in layers:
+                gid = int(layer[y, x]) if y < layer.shape[0] and x < layer.shape[1] else 0
+                if gid in animated:
+                    stack.append(animation(gid))
+                elif gid and self.tmxdata.get_tile_image_by_gid(gid):
+                    stack.append(tile(gid))
+            cells.append((int(x), int(y), tuple(stack)))
+
+        def load_tiles():
+            blank = pg.Surface((TILE_SIZE, TILE_SIZE), pg.SRCALPHA)
+            return [self.get_tile(gid) or blank for gid in gids]
+
+        return TileAnimations(load_tiles, animations, cells, self.chunk_size)
 
-    def render(self, surface):
-        ti = self.tmxdata.get_tile_image_by_gid
+    def animate(self, now):
+        if self.animations:
+            self.animations.animate(now)
+
+    def animated_rects(self, camera, size):
+        # Screen rects of the animated cells in view whose frame changed
+        if not self.animations:
+            return []
+        view = pg.Rect(-camera.camera.x, -camera.camera.y, *size)
+        return [camera.apply_rect(rect) for rect in self.animations.changed_rects(self.chunks_in(view), view)]
+
+    def render(self, surface, area=None):
+        # area is a rect in tiles, the whole map when omitted
+        if area is None:
+            area = pg.Rect(0, 0, self.tiles_x, self.tiles_y)
+        ti = self.get_tile
         for layer in self.tmxdata.visible_layers:
             if isinstance(layer, pytmx.TiledTileLayer):
-                for x, y, gid, in layer:
-                    tile = ti(gid)
-                    if tile:
-                        tile = pg.transform.scale(tile,(TILE_SIZE,TILE_SIZE))
-                        surface.blit(tile, (x * TILE_SIZE,
-                                            y * TILE_SIZE))
+                for y in range(area.top, min(area.bottom, layer.height)):
+                    row = layer.data[y]
+                    for x in range(area.left, min(area.right, layer.width)):
+                        tile = ti(row[x])
+                        if tile:
+                            surface.blit(tile, ((x - area.x) * TILE_SIZE,
+                                                (y - area.y) * TILE_SIZE))
 
     def make_map(self):
         temp_surface = pg.Surface((self.width, self.height), pg.SRCALPHA).convert_alpha()
         self.render(temp_surface)
-        return temp_surface
\ No newline at end of file
+        return temp_surface
+
+    def get_size(self):
+        # Bytes held by the parsed map, its baked chunks and animated tiles
+        size = self.parsed_size
+        size += sum(chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+                    for chunk in self.chunks.values())
+        if self.animations:
+            size += self.animations.get_size()
+        return size
+
+    def chunk_area(self, cx, cy):
+        # Tiles covered by a chunk, edge chunks are clipped to the map
+        area = pg.Rect(cx * self.chunk_size, cy * self.chunk_size, self.chunk_size, self.chunk_size)
+        return area.clip(pg.Rect(0, 0, self.tiles_x, self.tiles_y))
+
+    def make_chunk(self, cx, cy):
+        area = self.chunk_area(cx, cy)
+        temp_surface = pg.Surface((area.width * TILE_SIZE, area.height * TILE_SIZE), pg.SRCALPHA).convert_alpha()
+        self.render(temp_surface, area)
+        return temp_surface
+
+    def get_chunk(self, cx, cy):
+        key = (cx, cy)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+
+        chunk = self.make_chunk(cx, cy)
+        self.chunks[key] = chunk
+        while len(self.chunks) > self.cache_size:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def chunks_in(self, rect):
+        # Coordinates of the chunks intersecting a rect in pixels
+        size = self.chunk_px
+        first_x = max(0, rect.left // size)
+        first_y = max(0, rect.top // size)
+        last_x = min(self.chunks_x, (rect.right - 1) // size + 1)
+        last_y = min(self.chunks_y, (rect.bottom - 1) // size + 1)
+
+        for cy in range(first_y, last_y):
+            for cx in range(first_x, last_x):
+                yield cx, cy
+
+    def prebake(self, rect):
+        for cx, cy in self.chunks_in(rect):
+            self.get_chunk(cx, cy)
+
+    def draw(self, surface, camera):
+        # Only blit the chunks intersecting the camera
+        view = pg.Rect(-camera.camera.x, -camera.camera.y, *surface.get_size())
+        size = self.chunk_px
+
+        for cx, cy in self.chunks_in(view):
+            chunk = self.get_chunk(cx, cy)
+            surface.blit(chunk, camera.apply_rect(pg.Rect(cx * size, cy * size, size, size)))
+
+        # Animated cells in view over the still chunks
+        if self.animations:
+            self.animations.draw(surface, camera, self.chunks_in(view), view)
+
+class CollisionGrid:
+    # Static walls rasterized on the tile grid as a broad phase: each tile
+    # touched by walls points to the list of those walls, tiles with the
+    # same walls share one list. Hits are checked against the authored
+    # walls and come back in the order the walls group had.
+    def __init__(self, width, height, rects):
+        rects = [pg.Rect(rect) for rect in rects if rect.width and rect.height]
+        self.walls = rects
+
+        self.cell = TILE_SIZE
+        bounds = pg.Rect(0, 0, width, height).unionall(rects) if rects else pg.Rect(0, 0, width, height)
+        self.origin = (bounds.left // self.cell * self.cell, bounds.top // self.cell * self.cell)
+        self.cols = -(-(bounds.right - self.origin[0]) // self.cell)
+        self.rows = -(-(bounds.bottom - self.origin[1]) // self.cell)
+
+        self.solid = np.zeros((self.rows, self.cols), dtype=bool)
+        cells = {}
+        for i, rect in enumerate(rects):
+            x0, y0, x1, y1 = self.cells_under(rect)
+            self.solid[y0:y1, x0:x1] = True
+            for y in range(y0, y1):
+                for x in range(x0, x1):
+                    cells.setdefault((x, y), []).append(i)
+
+        self.index = np.full((self.rows, self.cols), -1, dtype=np.int32)
+        self.members = []
+        lists = {}
+        for (x, y), walls in cells.items():
+            key = tuple(walls)
+            if key not in lists:
+                lists[key] = len(self.members)
+                self.members.append(walls)
+            self.index[y, x] = lists[key]
+
+    def cells_under(self, rect):
+        ox, oy = self.origin
+        x0 = max(0, (rect.left - ox) // self.cell)
+        y0 = max(0, (rect.top - oy) // self.cell)
+        x1 = min(self.cols, (rect.right - 1 - ox) // self.cell + 1)
+        y1 = min(self.rows, (rect.bottom - 1 - oy) // self.cell + 1)
+        return x0, y0, x1, y1
+
+    def hits(self, rect):
+        x0, y0, x1, y1 = self.cells_under(rect)
+        if x0 >= x1 or y0 >= y1:
+            return []
+        found = set()
+        for id in np.unique(self.index[y0:y1, x0:x1]):
+            if id >= 0:
+                found.update(self.members[id])
+        return [self.walls[i] for i in sorted(found) if self.walls[i].colliderect(rect)]
+
+    def line_of_sight(self, start, end, target=None):
+        # True when no wall crosses the segment from start to end,
+        # a wall only crossed inside the target rect doesn't count
+        x0, y0 = int(start[0]), int(start[1])
+        x1, y1 = int(end[0]), int(end[1])
+        box = pg.Rect(min(x0, x1), min(y0, y1), abs(x1 - x0) + 1, abs(y1 - y0) + 1)
+        for wall in self.hits(box):
+            crossed = wall.clipline(x0, y0, x1, y1)
+            if not crossed:
+                continue
+            if target and target.collidepoint(crossed[0]) and target.collidepoint(crossed[1]):
+                continue
+            return False
+        return True
+
+class SpatialHash(pg.sprite.AbstractGroup):
+    # A sprite group bucketing its sprites' rects on a uniform grid.
+    # Sprites join it like any group and leave it when killed,
+    # moving sprites have to call move() after changing their rect.
+    def __init__(self, cell=SPATIAL_CELL_SIZE):
+        pg.sprite.AbstractGroup.__init__(self)
+        self.cell = cell
+        self.buckets = {}
+        self.keys = {}
+        self.order = {}
+        self.count = 0
+
+    def add_internal(self, sprite, layer=None):
+        pg.sprite.AbstractGroup.add_internal(self, sprite)
+        self.order[sprite] = self.count
+        self.count += 1
+        self.insert(sprite)
+
+    def remove_internal(self, sprite):
+        pg.sprite.AbstractGroup.remove_internal(self, sprite)
+        self.discard(sprite)
+        del self.order[sprite]
+
+    def cells_of(self, rect):
+        x0 = rect.left // self.cell
+        y0 = rect.top // self.cell
+        x1 = max(rect.left, rect.right - 1) // self.cell
+        y1 = max(rect.top, rect.bottom - 1) // self.cell
+        return tuple((x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1))
+
+    def insert(self, sprite):
+        keys = self.cells_of(sprite.rect)
+        self.keys[sprite] = keys
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(sprite)
+
+    def discard(self, sprite):
+        for key in self.keys.pop(sprite):
+            bucket = self.buckets[key]
+            bucket.discard(sprite)
+            if not bucket:
+                del self.buckets[key]
+
+    def move(self, sprite):
+        if sprite in self.keys and self.cells_of(sprite.rect) != self.keys[sprite]:
+            self.discard(sprite)
+            self.insert(sprite)
+
+    def query_rect(self, rect, group=None):
+        # Sprites colliding with rect, in the order they joined
+        found = set()
+        for key in self.cells_of(rect):
+            found.update(self.buckets.get(key, ()))
+
+        hits = [sprite for sprite in found
+                if sprite.rect.colliderect(rect) and (group is None or sprite in group)]
+        hits.sort(key=self.order.__getitem__)
+        return hits
+
+    def query_radius(self, pos, radius, group=None):
+        # Sprites whose rect comes within radius of pos
+        x, y = pos
+        box = pg.Rect(int(x - radius) - 1, int(y - radius) - 1, int(radius * 2) + 3, int(radius * 2) + 3)
+
+        hits = []
+        for sprite in self.query_rect(box, group):
+            dx = max(sprite.rect.left - x, 0, x - sprite.rect.right)
+            dy = max(sprite.rect.top - y, 0, y - sprite.rect.bottom)
+            if dx * dx + dy * dy <= radius * radius:
+                hits.append(sprite)
+        return hits
+
+    def query_nearest(self, pos, radius, group=None, accept=None):
+        # Closest sprite within radius of pos that accept() agrees with,
+        # by distance to its rect then to its center
+        x, y = pos
+
+        def distance(sprite):
+            dx = max(sprite.rect.left - x, 0, x - sprite.rect.right)
+            dy = max(sprite.rect.top - y, 0, y - sprite.rect.bottom)
+            cx, cy = sprite.rect.center
+            return dx * dx + dy * dy, (cx - x) ** 2 + (cy - y) ** 2
+
+        for sprite in sorted(self.query_radius(pos, radius, group), key=distance):
+            if accept is None or accept(sprite):
+                return sprite
+        return None
+
+# Compiled maps
+#
+# A .tmc file next to each .tmx holds, little-endian:
+#   header      MAP_HEADER, see below
+#   gids        one uint32 grid per tile layer, tiled gids with flip flags
+#   objects     one MAP_OBJECT record per tmx object
+#   strings     utf-8 object names referenced by the records
+#   pixels      the baked chunks in row order, BGRA, chunk after chunk
+#   animations  when some tile is animated, ANIM_COUNTS then each
+#               animation's frames, the animated cells with their
+#               layers and the pixels of the tiles they use, BGRA
+MAP_MAGIC = b'ROTS'
+MAP_VERSION = 2
+MAP_HEADER = struct.Struct('<4sHHH32sIIIIIQQQQQ')
+MAP_OBJECT = struct.Struct('<iIIffff')
+ANIM_COUNTS = struct.Struct('<III')         # tiles, animations, cells
+ANIM_FRAME = struct.Struct('<II')           # tile, duration in ms
+ANIM_CELL = struct.Struct('<IIH')           # x, y, layers
+COUNT = struct.Struct('<I')
+LAYER = struct.Struct('<i')
+
+# Flip flags stored in the high bits of tiled gids
+GID_FLIP_X = 1 << 31
+GID_FLIP_Y = 1 << 30
+GID_FLIP_DIAGONAL = 1 << 29
+
+MapObject = namedtuple('MapObject', 'id name x y width height')
+
+# Rough bytes of one parsed map object, for the map budget
+OBJECT_SIZE = 512
+
+def map_hash(filename):
+    # Hash of the tmx, its tilesets, their images and the bake settings
+    digest = hashlib.sha256()
+    digest.update(struct.pack('<HH', TILE_SIZE, CHUNK_SIZE))
+
+    def feed(file):
+        digest.update(path.basename(file).encode())
+        if path.isfile(file):
+            with open(file, 'rb') as f:
+                digest.update(f.read())
+
+    def feed_images(node, folder):
+        for image in node.iter('image'):
+            feed(path.join(folder, image.get('source')))
+
+    folder = path.dirname(filename)
+    feed(filename)
+    root = ET.parse(filename).getroot()
+    for tileset in root.iter('tileset'):
+        if tileset.get('source'):
+            tsx = path.join(folder, tileset.get('source'))
+            feed(tsx)
+            if path.isfile(tsx):
+                feed_images(ET.parse(tsx).getroot(), path.dirname(tsx))
+        else:
+            feed_images(tileset, folder)
+    return digest.digest()
+
+def compiled_filename(filename):
+    return path.splitext(filename)[0] + '.tmc'
+
+def compile_map(filename):
+    map = TiledMap(filename)
+    tm = map.tmxdata
+    tile_objects = list(tm.objects)
+
+    gids = array('I')
+    layers = [layer for layer in tm.visible_layers if isinstance(layer, pytmx.TiledTileLayer)]
+    for layer in layers:
+        for row in layer.data:
+            for gid in row:
+                gids.append(map.tiled_gid(gid))
+
+    strings = bytearray()
+    objects = bytearray()
+    for tile_object in tile_objects:
+        name = (tile_object.name or '').encode('utf-8')
+        objects += MAP_OBJECT.pack(tile_object.id, len(strings), len(name),
+                                   tile_object.x, tile_object.y, tile_object.width, tile_object.height)
+        strings += name
+
+    gids_offset = MAP_HEADER.size
+    objects_offset = gids_offset + len(gids) * gids.itemsize
+    strings_offset = objects_offset + len(objects)
+    pixels_offset = strings_offset + len(strings)
+    pixels_offset += -pixels_offset % 16
+
+    animations_offset = 0
+    animations = bytearray()
+    if map.animations:
+        map.animate(0)
+        anims = map.animations
+        animations += ANIM_COUNTS.pack(len(anims.tiles), len(anims.animations), len(anims.cell_list))
+        for tiles, durations in anims.animations:
+            animations += COUNT.pack(len(tiles))
+            for tile, duration in zip(tiles, durations):
+                animations += ANIM_FRAME.pack(tile, duration)
+        for x, y, stack in anims.cell_list:
+            animations += ANIM_CELL.pack(x, y, len(stack))
+            for layer in stack:
+                animations += LAYER.pack(layer)
+        for tile in anims.tiles:
+            animations += pg.image.tobytes(tile, 'BGRA')
+        # Right after the chunks, which cover the map once
+        animations_offset = pixels_offset + tm.width * tm.height * TILE_SIZE * TILE_SIZE * 4
+
+    header = MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, TILE_SIZE, CHUNK_SIZE, map_hash(filename),
+                             tm.width, tm.height, map.tilesize, len(layers), len(tile_objects),
+                             gids_offset, objects_offset, strings_offset, pixels_offset, animations_offset)
+
+    temp_filename = compiled_filename(filename) + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(header)
+        f.write(gids.tobytes())
+        f.write(objects)
+        f.write(strings)
+        f.write(bytes(pixels_offset - f.tell()))
+        for cy in range(map.chunks_y):
+            for cx in range(map.chunks_x):
+                f.write(pg.image.tobytes(map.make_chunk(cx, cy), 'BGRA'))
+        f.write(animations)
+    os.replace(temp_filename, compiled_filename(filename))
+    return compiled_filename(filename)
+
+class CompiledMap(TiledMap):
+    # A map loaded from its .tmc, chunks are surfaces over the mapped file
+    def __init__(self, filename, data, header, chunk_size=CHUNK_SIZE, cache_size=CHUNK_CACHE_SIZE):
+        (magic, version, tile_size, bake_chunk_size, digest, tiles_x, tiles_y, tilesize,
+         layers, objects, gids_offset, objects_offset, strings_offset, pixels_offset, animations_offset) = header
+
+        self.filename = filename
+        self.tilesize = tilesize
+        self.tmxdata = None
+        self.data = data
+        self.setup_chunks(tiles_x, tiles_y, chunk_size, cache_size)
+
+        view = memoryview(data)
+        layer_size = tiles_x * tiles_y * 4
+        self.layers = [view[gids_offset + i * layer_size:gids_offset + (i + 1) * layer_size].cast('I')
+                       for i in range(layers)]
+
+        self._objects = []
+        for i in range(objects):
+            id, name_offset, name_len, x, y, w, h = MAP_OBJECT.unpack_from(data, objects_offset + i * MAP_OBJECT.size)
+            start = strings_offset + name_offset
+            name = bytes(view[start:start + name_len]).decode('utf-8') or None
+            self._objects.append(MapObject(id, name, x, y, w, h))
+
+        # Byte offset of every chunk in the pixel section
+        self.chunk_offsets = {}
+        offset = pixels_offset
+        for cy in range(self.chunks_y):
+            for cx in range(self.chunks_x):
+                self.chunk_offsets[(cx, cy)] = offset
+                area = self.chunk_area(cx, cy)
+                offset += area.width * area.height * TILE_SIZE * TILE_SIZE * 4
+
+        self.animations = self.read_animations(animations_offset) if animations_offset else None
+        # The gids and pixels stay in the mapped file, only the objects are parsed
+        self.parsed_size = objects * OBJECT_SIZE
+
+    @classmethod
+    def load(cls, filename):
+        # None when the compiled map is missing or stale
+        compiled = compiled_filename(filename)
+        if not path.isfile(compiled):
+            return None
+
+        with open(compiled, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None
+
+        if len(data) < MAP_HEADER.size:
+            return None
+        header = MAP_HEADER.unpack_from(data, 0)
+        magic, version, tile_size, chunk_size, digest = header[:5]
+        if (magic, version, tile_size, chunk_size) != (MAP_MAGIC, MAP_VERSION, TILE_SIZE, CHUNK_SIZE):
+            return None
+        if digest != map_hash(filename):
+            return None
+        if not cls.fits(header, len(data)):
+            return None
+        # A corrupt file whose sections still fit falls back to the tmx too
+        try:
+            return cls(filename, data, header)
+        except (struct.error, ValueError, TypeError, IndexError):
+            return None
+
+    @staticmethod
+    def fits(header, size):
+        # True when every section of the header lies inside the file, in order
+        (magic, version, tile_size, chunk_size, digest, tiles_x, tiles_y, tilesize,
+         layers, objects, gids_offset, objects_offset, strings_offset, pixels_offset, animations_offset) = header
+        pixels_end = pixels_offset + tiles_x * tiles_y * TILE_SIZE * TILE_SIZE * 4
+        if gids_offset < MAP_HEADER.size:
+            return False
+        if gids_offset + layers * tiles_x * tiles_y * 4 > objects_offset:
+            return False
+        if objects_offset + objects * MAP_OBJECT.size > strings_offset:
+            return False
+        if strings_offset > pixels_offset or pixels_end > size:
+            return False
+        if animations_offset and (animations_offset < pixels_end or animations_offset + ANIM_COUNTS.size > size):
+            return False
+        return True
+
+    @property
+    def objects(self):
+        return self._objects
+
+    def read_animations(self, offset):
+        tile_count, animation_count, cell_count = ANIM_COUNTS.unpack_from(self.data, offset)
+        offset += ANIM_COUNTS.size
+
+        animations = []
+        for i in range(animation_count):
+            count, = COUNT.unpack_from(self.data, offset)
+            offset += COUNT.size
+            frames = [ANIM_FRAME.unpack_from(self.data, offset + j * ANIM_FRAME.size) for j in range(count)]
+            offset += count * ANIM_FRAME.size
+            animations.append(([tile for tile, duration in frames], [duration for tile, duration in frames]))
+
+        cells = []
+        for i in range(cell_count):
+            x, y, count = ANIM_CELL.unpack_from(self.data, offset)
+            offset += ANIM_CELL.size
+            cells.append((x, y, tuple(LAYER.unpack_from(self.data, offset + j * LAYER.size)[0] for j in range(count))))
+            offset += count * LAYER.size
+
+        # The tiles are surfaces over the mapped file, like the chunks
+        size = TILE_SIZE * TILE_SIZE * 4
+        if offset + tile_count * size > len(self.data):
+            raise ValueError("animation tiles past the end of the file")
+        for tiles, durations in animations:
+            if any(not 0 <= tile < tile_count for tile in tiles):
+                raise ValueError("animation frame out of range")
+        for x, y, layers in cells:
+            if any(not -animation_count <= layer < tile_count for layer in layers):
+                raise ValueError("animated cell out of range")
+        def load_tiles():
+            view = memoryview(self.data)
+            return [pg.image.frombuffer(view[offset + i * size:offset + (i + 1) * size], (TILE_SIZE, TILE_SIZE), 'BGRA')
+                    for i in range(tile_count)]
+
+        return TileAnimations(load_tiles, animations, cells, self.chunk_size)
+
+    def render(self, surface, area=None):
+        if area is None:
+            area = pg.Rect(0, 0, self.tiles_x, self.tiles_y)
+        for cx, cy in self.chunks_in(pg.Rect(area.x * TILE_SIZE, area.y * TILE_SIZE,
+                                             area.width * TILE_SIZE, area.height * TILE_SIZE)):
+            surface.blit(self.make_chunk(cx, cy), ((cx * self.chunk_size - area.x) * TILE_SIZE,
+                                                   (cy * self.chunk_size - area.y) * TILE_SIZE))
+
+    def make_chunk(self, cx, cy):
+        area = self.chunk_area(cx, cy)
+        size = (area.width * TILE_SIZE, area.height * TILE_SIZE)
+        offset = self.chunk_offsets[(cx, cy)]
+        return pg.image.frombuffer(memoryview(self.data)[offset:offset + size[0] * size[1] * 4], size, 'BGRA')
+
+def open_map(filename, convert=True):
+    # Use the compiled map when it is up to date, the tmx otherwise
+    map = CompiledMap.load(filename)
+    if map is None:
+        map = TiledMap(filename, convert=convert)
+    return map
+
+class MapRegistry:
+    # Loads maps on first request and keeps the most recently used ones
+    # while their parsed data and baked surfaces fit in the byte budget.
+    # Chunks are baked after a map is added, so the game calls evict()
+    # once per frame as well.
+    def __init__(self, folder, budget=MAP_CACHE_BUDGET):
+        self.folder = folder
+        self.budget = budget
+        self.maps = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.maps
+
+    def get(self, name):
+        if name in self.maps:
+            self.maps.move_to_end(name)
+            self.evict()
+            return self.maps[name]
+
+        map = open_map(path.join(self.folder, name))
+        self.loads += 1
+        self.add(name, map)
+        return map
+
+    def add(self, name, map):
+        self.maps[name] = map
+        self.maps.move_to_end(name)
+        self.evict()
+
+    def discard(self, name):
+        self.maps.pop(name, None)
+
+    def evict(self, keep=()):
+        # Neither the most recently requested map nor the ones in keep
+        # are evicted. A view may still hold an evicted map, its chunks
+        # are dropped so they are freed all the same.
+        size = self.get_size()
+        for name in list(self.maps)[:-1]:
+            if size <= self.budget:
+                break
+            if name in keep:
+                continue
+            map = self.maps.pop(name)
+            size -= map.get_size()
+            map.chunks.clear()
+            self.evictions += 1
+
+    def get_size(self):
+        return sum(map.get_size() for map in self.maps.values())
+
+class Prefetcher:
+    # Parses the maps reachable from the current one on a worker thread.
+    # Surfaces are converted and the views built on the main thread by poll(),
+    # a slice of a frame at a time, the tile cache is only ever touched there.
+    def __init__(self, game):
+        self.game = game
+        self.states = {}
+        self.requests = queue.Queue()
+        self.done = queue.Queue()
+        self.building = None
+
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def neighbours(self, map_name):
+        # Teleport triggers lead to a passage, the passage tells the map
+        for tile_object in self.game.maps.get(map_name).objects:
+            if tile_object.name in TRIGGERS and TRIGGERS[tile_object.name]['action'] == 'teleport':
+                dest = TRIGGERS[tile_object.name]['destination']
+                yield PASSAGES[dest]['location'], dest
+
+    def request(self, map_name):
+        for dest_map, dest in self.neighbours(map_name):
+            if dest_map in self.game.views or self.is_pending(dest_map):
+                continue
+
+            if dest_map in self.game.maps:
+                # Already parsed, only the view is missing
+                self.states[dest_map] = 'loading'
+                self.done.put((dest_map, None, None, None))
+            else:
+                self.states[dest_map] = 'queued'
+                self.requests.put((dest_map, dest))
+
+    def work(self):
+        while True:
+            map_name, dest = self.requests.get()
+            self.states[map_name] = 'loading'
+            try:
+                map = open_map(path.join(self.game.maps_folder, map_name), False)
+                self.done.put((map_name, map, self.arrival_rect(map, dest), None))
+            except Exception as err:
+                self.done.put((map_name, None, None, err))
+
+    def arrival_rect(self, map, dest):
+        # A screen around the passage the player will arrive at
+        scale = int(TILE_SIZE / map.tilesize)
+        rect = pg.Rect(0, 0, WIDTH, HEIGHT)
+        for tile_object in map.objects:
+            if tile_object.name == dest:
+                rect.center = (tile_object.x * scale, tile_object.y * scale)
+        return rect
+
+    def poll(self):
+        # Called once per frame, works on one view for PREFETCH_SLICE at most
+        if self.building is None:
+            try:
+                map_name, map, arrival, err = self.done.get_nowait()
+            except queue.Empty:
+                return
+            self.finish(map_name, map, arrival, err)
+        if self.building is not None:
+            self.build(PREFETCH_SLICE)
+
+    def wait(self, map_name):
+        # Block until a pending prefetch of map_name has landed
+        while self.is_pending(map_name):
+            if self.building is not None:
+                self.build()
+            else:
+                self.finish(*self.done.get())
+
+    def build(self, budget=None):
+        map_name, builder = self.building
+        view = builder.run(budget)
+        if view is not None:
+            self.building = None
+            self.game.views[map_name] = view
+            self.states[map_name] = 'ready'
+
+    def finish(self, map_name, map, arrival, err):
+        if err is not None:
+            print("Couldn't prefetch {}: {}".format(map_name, err))
+            del self.states[map_name]
+            return
+
+        if map is not None:
+            map.prebake(arrival)
+            self.game.maps.add(map_name, map)
+        if map_name in self.game.views:
+            self.states[map_name] = 'ready'
+        else:
+            # The view is built over the next frames
+            self.building = (map_name, self.game.view_builder(map_name))
+            self.states[map_name] = 'building'
+
+    def is_pending(self, map_name):
+        return self.states.get(map_name) in ('queued', 'loading', 'building')
+
+    def state(self, map_name):
+        return self.states.get(map_name)